@@ -41,6 +41,10 @@ class Ui_m3ew(object):
         self.verticalLayout_2 = QtWidgets.QVBoxLayout(self.layoutWidget)
         self.verticalLayout_2.setContentsMargins(0, 0, 0, 0)
         self.verticalLayout_2.setObjectName("verticalLayout_2")
+        self.edtModelSearch = QtWidgets.QLineEdit(self.layoutWidget)
+        self.edtModelSearch.setClearButtonEnabled(True)
+        self.edtModelSearch.setObjectName("edtModelSearch")
+        self.verticalLayout_2.addWidget(self.edtModelSearch)
         self.tagsTree = QtWidgets.QTreeView(self.layoutWidget)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
         sizePolicy.setHorizontalStretch(0)
@@ -205,6 +209,8 @@ class Ui_m3ew(object):
         m3ew.setMenuBar(self.menubar)
         self.statusbar = QtWidgets.QStatusBar(m3ew)
         self.statusbar.setObjectName("statusbar")
+        self.lblProfile = QtWidgets.QLabel(self.statusbar)
+        self.lblProfile.setObjectName("lblProfile")
         m3ew.setStatusBar(self.statusbar)
         self.actionOpen = QtWidgets.QAction(m3ew)
         self.actionOpen.setObjectName("actionOpen")
@@ -233,6 +239,17 @@ class Ui_m3ew(object):
         self.actionSave_as = QtWidgets.QAction(m3ew)
         self.actionSave_as.setEnabled(False)
         self.actionSave_as.setObjectName("actionSave_as")
+        self.actionTreeBackgroundBuild = QtWidgets.QAction(m3ew)
+        self.actionTreeBackgroundBuild.setCheckable(True)
+        self.actionTreeBackgroundBuild.setObjectName("actionTreeBackgroundBuild")
+        self.actionProfiling = QtWidgets.QAction(m3ew)
+        self.actionProfiling.setCheckable(True)
+        self.actionProfiling.setObjectName("actionProfiling")
+        self.actionSaveProfile = QtWidgets.QAction(m3ew)
+        self.actionSaveProfile.setEnabled(False)
+        self.actionSaveProfile.setObjectName("actionSaveProfile")
+        self.actionMemoryReport = QtWidgets.QAction(m3ew)
+        self.actionMemoryReport.setObjectName("actionMemoryReport")
         self.actionExit = QtWidgets.QAction(m3ew)
         self.actionExit.setObjectName("actionExit")
         self.actionConfirm_Flag_Bits_edit = QtWidgets.QAction(m3ew)
@@ -251,6 +268,11 @@ class Ui_m3ew(object):
         self.menuSimple_and_Binary_Display_Count.addAction(self.actionSimpleDisplayCount500)
         self.menuView.addAction(self.menuSimple_and_Binary_Display_Count.menuAction())
         self.menuView.addAction(self.actionFields_Auto_Expand_All)
+        self.menuView.addAction(self.actionTreeBackgroundBuild)
+        self.menuView.addSeparator()
+        self.menuView.addAction(self.actionProfiling)
+        self.menuView.addAction(self.actionSaveProfile)
+        self.menuView.addAction(self.actionMemoryReport)
         self.menuEdit.addAction(self.actionConfirm_Flag_Bits_edit)
         self.menubar.addAction(self.menuFile.menuAction())
         self.menubar.addAction(self.menuEdit.menuAction())
@@ -265,6 +287,7 @@ class Ui_m3ew(object):
         _translate = QtCore.QCoreApplication.translate
         m3ew.setWindowTitle(_translate("m3ew", "M3 Editor"))
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.tabInfo), _translate("m3ew", "Info"))
+        self.edtModelSearch.setPlaceholderText(_translate("m3ew", "Search names, strings and values"))
         self.btnItemBack.setText(_translate("m3ew", "..."))
         self.btnItemForw.setText(_translate("m3ew", "..."))
         self.edtItemNavi.setText(_translate("m3ew", "1234567890 - 1234567890"))
@@ -289,6 +312,10 @@ class Ui_m3ew(object):
         self.actionReopen.setText(_translate("m3ew", "Reopen"))
         self.actionSave.setText(_translate("m3ew", "Save"))
         self.actionSave_as.setText(_translate("m3ew", "Save as ..."))
+        self.actionTreeBackgroundBuild.setText(_translate("m3ew", "Build Tags Tree in Background"))
+        self.actionProfiling.setText(_translate("m3ew", "Profile Loading and Saving"))
+        self.actionSaveProfile.setText(_translate("m3ew", "Save Profiling Data..."))
+        self.actionMemoryReport.setText(_translate("m3ew", "Memory Report..."))
         self.actionExit.setText(_translate("m3ew", "Exit"))
         self.actionConfirm_Flag_Bits_edit.setText(_translate("m3ew", "Confirm Flag Bits edit"))
 from ui3dView import m3glWidget
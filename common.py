@@ -13,20 +13,35 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
 from struct import pack
 from configparser import ConfigParser
-from PyQt5.QtWidgets import QAction
+from typing import List, TYPE_CHECKING
+import os
+if TYPE_CHECKING:
+    # only for annotations, model parsing modules must not load Qt
+    from PyQt5.QtWidgets import QAction
 
 class Options():
     SECT_MAIN = 'main'
     SECT_TREE_VIEW = 'tree_view'
 
+    OPT_MMAP_LOADING = (SECT_MAIN, 'mmap_loading')
+    OPT_PROFILING = (SECT_MAIN, 'profiling')
     OPT_CONFIRM_BIT_EDIT = (SECT_TREE_VIEW, 'confirm_bit_edit')
     OPT_FIELDS_AUTO_EXPAND = (SECT_TREE_VIEW, 'field_auto_expand')
+    OPT_TREE_BACKGROUND_BUILD = (SECT_TREE_VIEW, 'background_build')
 
     def __init__(self):
-        self.ini = ConfigParser()
-        self.ini.read('options.ini')
+        self._ini = None # type: ConfigParser | None
+
+    @property
+    def ini(self) -> ConfigParser:
+        '''options.ini is read on first use'''
+        if self._ini is None:
+            self._ini = ConfigParser()
+            self._ini.read('options.ini')
+        return self._ini
 
     def setIniOption(self, sect, opt, val, saveINI = False):
         if not sect in self.ini:
@@ -84,6 +99,20 @@ def float_to_fixed16(val):
         raise ValueError('fixed16 value must be in range from 0.0 to 32.0')
     return clampi(val * 2048, 0, 0xFFFF)
 
+M3_EXTENSIONS = ('.m3', '.m3a')
+
+def collectFiles(paths: List[str]) -> List[str]:
+    '''Expand directories into sorted list of m3 files they contain'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, n) for n in sorted(names) if n.lower().endswith(M3_EXTENSIONS))
+        else:
+            files.append(path)
+    return files
+
 TAG_SIZE_STEP = 0x10
 def getTagStepNeededBytes(count):
     return max(1, ceildiv(count, TAG_SIZE_STEP))*TAG_SIZE_STEP - count
@@ -122,10 +122,10 @@ class ColorFieldEdit(QDialog):
             offset = tag.info.item_size * item + field.offset
             if field.type_name == m3.COL.self__:
                 val = convert_COL_back(*self.value)
-                pack_into('<BBBB', tag.data, offset, *val)
+                pack_into('<BBBB', tag.getWritableData(), offset, *val)
             elif field.type_name == m3.VEC3.self__:
                 val = self.value[:3]
-                pack_into('<fff', tag.data, offset, *val)
+                pack_into('<fff', tag.getWritableData(), offset, *val)
 
     def setRGB_spin(self, idx, val):
         if self.updating: return
@@ -47,7 +47,7 @@ class flag_bits_handler(AbstractFieldHandler):
             max_bit = field.size * 8
             mask = 2**max_bit - 1 - field.bitMask
             val = val & mask
-        pack_into(fmt, tag.data, offset, val)
+        pack_into(fmt, tag.getWritableData(), offset, val)
 
     def fieldData(self, role: Qt.ItemDataRole, tag: m3Tag, item: int, field: m3FieldInfo):
         if role == Qt.ItemDataRole.CheckStateRole:
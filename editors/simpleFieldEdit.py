@@ -76,7 +76,7 @@ class SimpleFieldEdit(QtWidgets.QDialog):
             if ret == RESULT_OK:
                 if self.value != self.init_value:
                     offset = tag.info.item_size * item + field.offset
-                    pack_into(self.val_format, tag.data, offset, self.value)
+                    pack_into(self.val_format, tag.getWritableData(), offset, self.value)
                 return True
             if ret == RESULT_CANCEL:
                 return True # editing is finished even if it got canceled
@@ -0,0 +1,138 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''Headless batch processing of m3 files, results are printed as JSON lines
+
+    python m3batch.py info models/
+    python m3batch.py validate -j 8 models/ > report.jsonl
+    python m3batch.py strings --suffix .dds a.m3 b.m3
+    python m3batch.py resave --output-dir out/ models/
+'''
+from typing import Dict
+from m3struct import m3TagToStr, TAG_CHAR, DEFAULT_STRUCT_FILE
+from m3file import m3File, HEADER_STRUCT, INDEX_REF_SIZE, IDX_TAG, IDX_OFFSET, IDX_COUNT
+from common import collectFiles
+import argparse, json, m3pool, os, sys, time
+
+def cmdInfo(m3: m3File, args) -> Dict:
+    tags = {} # type: Dict[str, int]
+    for item in m3.index[1:]:
+        name = m3TagToStr(item[IDX_TAG])
+        tags[name] = tags.get(name, 0) + 1
+    return {
+        'tag_count': m3.tag_count,
+        'modl_version': m3.modl.ver,
+        'vflags': m3.vflags,
+        'vertices': m3.vert.count if m3.vert else 0,
+        'orphans': len(m3.orphans),
+        'tags': tags,
+    }
+
+def cmdValidate(m3: m3File, args) -> Dict:
+    problems = []
+    size = len(m3.data)
+    index_end = m3.index_offset + INDEX_REF_SIZE * m3.tag_count
+    if index_end > size:
+        problems.append(f'Tag index ends at {index_end}, file size is {size}')
+    prev = HEADER_STRUCT.size
+    for idx in range(1, m3.tag_count):
+        item = m3.index[idx]
+        name = m3TagToStr(item[IDX_TAG])
+        if item[IDX_OFFSET] < prev or item[IDX_OFFSET] > m3.index_offset:
+            problems.append(f'{name}#{idx}: data offset {item[IDX_OFFSET]} is out of order')
+        prev = item[IDX_OFFSET]
+        if m3.structs.ByTag(item[IDX_TAG]) is None:
+            problems.append(f'{name}#{idx}: unknown structure')
+            continue
+        tag = m3.tags[idx]
+        if tag.info.item_size and tag.count * tag.info.item_size > len(tag.data):
+            problems.append(f'{name}#{idx}: {tag.count} items do not fit into {len(tag.data)} bytes')
+        if not tag.info.ref_codec: continue
+        count = min(tag.count, len(tag.data) // tag.info.item_size)
+        for item_idx, refs in enumerate(tag.info.ref_codec.iter_unpack(memoryview(tag.data)[:count * tag.info.item_size])):
+            for f, ref_count, ref_idx in zip(tag.info.ref_fields, refs[0::2], refs[1::2]):
+                if ref_count == 0: continue
+                if not 0 < ref_idx < m3.tag_count:
+                    problems.append(f'{name}#{idx}[{item_idx}] {f.name}: index {ref_idx} is out of range')
+                    continue
+                target = m3.index[ref_idx]
+                if f.refTo and m3TagToStr(target[IDX_TAG]) != f.refTo:
+                    problems.append(f'{name}#{idx}[{item_idx}] {f.name}: points to {m3TagToStr(target[IDX_TAG])}#{ref_idx}, expected {f.refTo}')
+                elif ref_count != target[IDX_COUNT]:
+                    problems.append(f'{name}#{idx}[{item_idx}] {f.name}: count {ref_count} differs from {target[IDX_COUNT]} items in target')
+    return {'ok': len(problems) == 0, 'problems': problems[:args.max_problems], 'problem_count': len(problems)}
+
+def cmdStrings(m3: m3File, args) -> Dict:
+    strings = []
+    for idx in m3.tagIndices(TAG_CHAR):
+        tag = m3.tags[idx]
+        if tag.isStr():
+            s = tag.getStr()
+            if s.endswith(args.suffix) and not s in strings:
+                strings.append(s)
+    return {'strings': strings}
+
+def cmdResave(m3: m3File, args) -> Dict:
+    if args.output_dir:
+        out = os.path.join(args.output_dir, os.path.relpath(os.path.abspath(m3.fileName), args.base_dir))
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    else:
+        out = m3.fileName
+    return {'output': out, 'size': m3.saveToFile(out)}
+
+COMMANDS = {
+    'info': cmdInfo,
+    'validate': cmdValidate,
+    'strings': cmdStrings,
+    'resave': cmdResave,
+}
+
+def processFile(job) -> Dict:
+    fileName, args = job
+    res = {'file': fileName, 'ok': True}
+    t = time.perf_counter()
+    try:
+        m3 = m3File(fileName, m3pool.structs, args.mmap)
+        res.update(COMMANDS[args.command](m3, args))
+    except Exception as e: # damaged files may raise struct.error, IndexError, etc. batch should go on
+        res['ok'] = False
+        res['error'] = f'{type(e).__name__}: {e}'
+    res['time'] = round(time.perf_counter() - t, 4)
+    return res
+
+def main(argv = None) -> int:
+    parser = argparse.ArgumentParser(description='Process m3 files without GUI, one JSON line is printed per file')
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    parser.add_argument('paths', nargs='+', help='m3 files or directories to scan for *.m3 and *.m3a')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--structures', default=DEFAULT_STRUCT_FILE, help='path to structures.xml')
+    parser.add_argument('--mmap', action='store_true', help='map files into memory instead of reading them')
+    parser.add_argument('--suffix', default='', help='strings: only report strings ending with suffix')
+    parser.add_argument('--max-problems', type=int, default=100, help='validate: problems listed per file')
+    parser.add_argument('--output-dir', default='', help='resave: write into this directory instead of replacing files')
+    args = parser.parse_args(argv)
+
+    files = collectFiles(args.paths)
+    args.base_dir = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in files]) if files else ''
+    jobs = [(f, args) for f in files]
+    failed = 0
+    with m3pool.mapFiles(processFile, jobs, args.jobs, args.structures) as results:
+        for res in results:
+            if not res['ok']: failed += 1
+            print(json.dumps(res), flush=True)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''Benchmarks of model loading and editing hot paths on synthetic models, runs without display
+
+    python m3bench.py
+    python m3bench.py --bones 3000 --vertices 200000 --sequences 20 --animated-bones 500 --repeat 5 --memory --json report.json
+'''
+from typing import Callable, Dict
+from m3struct import m3StructFile, m3Type, IDX_VERS, DEFAULT_STRUCT_FILE
+from m3file import m3File
+from m3gen import writeModel, DEFAULT_VFLAGS
+from m3search import m3ModelSearch
+import argparse, json, os, platform, shutil, statistics, sys, tempfile, time, tracemalloc
+try:
+    from uiTreeView import ShadowTree
+except ImportError: # PyQt5 is missing, tags tree stage is skipped
+    ShadowTree = None
+
+def measure(name, func: Callable, repeat, setup: Callable = None, memory = False) -> Dict:
+    '''Run func(setup()) repeat times, report best and median time in seconds and peak of traced memory if memory is set'''
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup else None
+        t = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - t)
+        del arg
+    res = {'stage': name, 'best': min(times), 'median': statistics.median(times)}
+    if memory:
+        arg = setup() if setup else None
+        tracemalloc.start()
+        func(arg)
+        res['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return res
+
+def accessAllFields(m3: m3File):
+    for idx in range(1, m3.tag_count):
+        tag = m3.tags[idx]
+        if tag.info.simple or tag.info.type == m3Type.CHAR: continue
+        fields = [f for f in tag.info.fields if f.notSelfField]
+        for item in range(min(tag.count, 1000)):
+            for f in fields:
+                tag.getFieldAsStr(item, f)
+
+def accessAllColumns(m3: m3File):
+    for idx in range(1, m3.tag_count):
+        tag = m3.tags[idx]
+        for f in tag.info.fields:
+            if f.notSelfField and f.codec:
+                tag.getColumn(f)
+
+def buildAllLayouts(structs: m3StructFile):
+    '''Field layouts of every structure version, as opening many different models would'''
+    for tag, struct in structs.structByTag.items():
+        for ver in struct.get(IDX_VERS) or (0,):
+            structs.getStructInfo(tag, ver)
+    return structs
+
+def runBenchmarks(args) -> Dict:
+    workDir = tempfile.mkdtemp(prefix='m3bench')
+    try:
+        xmlFile = os.path.join(workDir, 'structures.xml')
+        shutil.copy(args.structures, xmlFile) # cache file of the copy is created in workDir
+        structs = m3StructFile()
+        structs.loadFromFile(xmlFile)
+        model = os.path.join(workDir, 'model.m3')
+        out = os.path.join(workDir, 'out.m3')
+        t = time.perf_counter()
+        tag_count = writeModel(model, structs, bones=args.bones, vertices=args.vertices, regions=args.regions,
+            sequences=args.sequences, animated_bones=args.animated_bones, keys=args.keys, vflags=args.vflags)
+        build_time = time.perf_counter() - t
+
+        def loaded(): return m3File(model, structs)
+        def loadedAll():
+            m3 = m3File(model, structs)
+            for tag in m3.tags: pass
+            return m3
+        def parsed():
+            s = m3StructFile()
+            s.loadFromFile(xmlFile)
+            return s
+        stages = [
+            ('structures_parse', lambda a: m3StructFile().loadFromFile(xmlFile, False), None),
+            ('structures_cached', lambda a: m3StructFile().loadFromFile(xmlFile), None),
+            ('load', lambda a: m3File(model, structs), None),
+            ('load_mmap', lambda a: m3File(model, structs, True), None),
+            ('reloadFromData', lambda m3: m3.reloadFromData(), loaded),
+            ('create_all_tags', lambda m3: [tag for tag in m3.tags], loaded),
+            ('rebildRefFrom', lambda m3: m3.rebildRefFrom(), loadedAll),
+            ('getFieldAsStr', accessAllFields, loadedAll),
+            ('getColumn', accessAllColumns, loadedAll),
+            ('struct_layouts', buildAllLayouts, parsed),
+            ('search_index', lambda m3: m3ModelSearch(m3).build(), loadedAll),
+            ('repackIntoData', lambda m3: m3.repackIntoData(), loadedAll),
+            ('saveToFile', lambda m3: m3.saveToFile(out), loadedAll),
+        ]
+        if ShadowTree:
+            stages.append(('shadow_tree', ShadowTree, loadedAll))
+            stages.append(('shadow_tree_all', lambda m3: ShadowTree(m3).fetchAll(), loadedAll))
+        results = [measure(name, func, args.repeat, setup, args.memory) for name, func, setup in stages if not args.stage or name in args.stage]
+        return {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'model': {
+                'bones': args.bones, 'vertices': args.vertices, 'regions': args.regions, 'sequences': args.sequences,
+                'animated_bones': args.animated_bones, 'keys': args.keys, 'tags': tag_count, 'vflags': args.vflags,
+                'size': os.path.getsize(model), 'build_time': build_time,
+            },
+            'repeat': args.repeat,
+            'stages': results,
+        }
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+def printReport(report: Dict):
+    m = report['model']
+    print(f"model: {m['tags']} tags, {m['bones']} bones, {m['vertices']} vertices, {m['sequences']} sequences, {m['size']/1e6:.1f} MB, vflags 0x{m['vflags']:x}")
+    print(f"{'stage':<20}{'best, ms':>12}{'median, ms':>12}{'peak, MB':>10}")
+    for s in report['stages']:
+        peak = f"{s['peak_bytes']/1e6:.1f}" if 'peak_bytes' in s else '-'
+        print(f"{s['stage']:<20}{s['best']*1000:>12.2f}{s['median']*1000:>12.2f}{peak:>10}")
+
+def main(argv = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark model loading, reference rebuild, field access and saving on a synthetic model')
+    parser.add_argument('--structures', default=DEFAULT_STRUCT_FILE, help='path to structures.xml')
+    parser.add_argument('--bones', type=int, default=500)
+    parser.add_argument('--vertices', type=int, default=20000)
+    parser.add_argument('--regions', type=int, default=4)
+    parser.add_argument('--sequences', type=int, default=10)
+    parser.add_argument('--animated-bones', type=int, default=100, help='bones with keys in every sequence')
+    parser.add_argument('--keys', type=int, default=10, help='keys per animated track')
+    parser.add_argument('--vflags', type=lambda s: int(s, 0), default=DEFAULT_VFLAGS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--memory', action='store_true', help='measure peak traced memory of each stage in extra run')
+    parser.add_argument('--stage', action='append', help='run only given stage, can be repeated')
+    parser.add_argument('--json', default='', help='write report into JSON file')
+    args = parser.parse_args(argv)
+    report = runBenchmarks(args)
+    printReport(report)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
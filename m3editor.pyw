@@ -13,19 +13,21 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import List, Callable
+from typing import List, Callable, Tuple
 from PyQt5 import QtWidgets, QtGui
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import QMessageBox as mb, QFileDialog as fd
 from Ui_editorWindow import Ui_m3ew
 from m3file import m3File
-from m3struct import m3StructFile, m3FieldInfo
-from uiTreeView import TagTreeModel, fieldsTableModel, ShadowItem
+from m3struct import m3StructFile, m3FieldInfo, DEFAULT_STRUCT_FILE
+from uiTreeView import TagTreeModel, fieldsTableModel, ShadowItem, SearchIndexBuilder
+from m3search import m3ModelSearch
 from editors.simpleFieldEdit import SimpleFieldEdit
 from editors.flagsFieldEdit import FlagsFieldEdit
 from editors.fieldHandlers import fieldHandlersCollection
 from common import options
-import sys, os, requests
+from m3mem import memoryReport, formatReport
+import sys, os, requests, m3prof
 
 class mainWin(QtWidgets.QMainWindow):
 
@@ -33,7 +35,7 @@ class mainWin(QtWidgets.QMainWindow):
         super(mainWin, self).__init__()
 
         self.struct = m3StructFile()
-        self.struct.loadFromFile('structures.xml')
+        self.struct.loadFromFile(DEFAULT_STRUCT_FILE)
         self.lastFile = ''
 
         self.ui = Ui_m3ew()
@@ -47,6 +49,20 @@ class mainWin(QtWidgets.QMainWindow):
         self.ui.tagsTree.selectionModel().currentChanged.connect(self.tagTreeClick)
         self.resetItemNaviText('##')
 
+        ### Model Search ###
+
+        self.search = None # type: m3ModelSearch | None
+        self.searchBuilder = None # type: SearchIndexBuilder | None
+        self.searchResults = [] # type: List[Tuple[int, int, str | None]]
+        self.searchModel = QStringListModel(self)
+        self.searchCompleter = QtWidgets.QCompleter(self.searchModel, self)
+        self.searchCompleter.setCompletionMode(QtWidgets.QCompleter.CompletionMode.UnfilteredPopupCompletion)
+        self.searchCompleter.setMaxVisibleItems(20)
+        self.ui.edtModelSearch.setCompleter(self.searchCompleter)
+        self.ui.edtModelSearch.textEdited.connect(self.modelSearchEdited)
+        self.searchCompleter.activated[QModelIndex].connect(self.modelSearchActivated)
+        self.tagsModel.buildFinished.connect(self.startSearchBuilder)
+
         self.simpleEditor = SimpleFieldEdit(self)
         self.flagEditor = FlagsFieldEdit(self)
         self.handlers = fieldHandlersCollection(self)
@@ -106,6 +122,17 @@ class mainWin(QtWidgets.QMainWindow):
 
         options.connectWithActionCheckState(self.ui.actionConfirm_Flag_Bits_edit, options.OPT_CONFIRM_BIT_EDIT, True)
         options.connectWithActionCheckState(self.ui.actionFields_Auto_Expand_All, options.OPT_FIELDS_AUTO_EXPAND, True)
+        options.connectWithActionCheckState(self.ui.actionTreeBackgroundBuild, options.OPT_TREE_BACKGROUND_BUILD, True)
+
+        ### Profiling ###
+
+        self.ui.statusbar.addPermanentWidget(self.ui.lblProfile)
+        options.connectWithActionCheckState(self.ui.actionProfiling, options.OPT_PROFILING, False)
+        self.ui.actionProfiling.triggered.connect(self.setProfiling)
+        self.ui.actionSaveProfile.triggered.connect(self.saveProfile)
+        # off by default, M3EDITOR_PROFILE=1 turns it on without changing options.ini
+        self.setProfiling(os.environ.get('M3EDITOR_PROFILE', '0') != '0' or self.ui.actionProfiling.isChecked())
+        self.ui.actionMemoryReport.triggered.connect(self.showMemoryReport)
 
     def resetItemNaviText(self, new_text = None):
         if new_text:
@@ -136,6 +163,55 @@ class mainWin(QtWidgets.QMainWindow):
                 self.resetItemNaviText()
                 mb.critical(self, 'Ivalid input', f'"{text}" is not a valid integer value')
 
+    def startSearchBuilder(self):
+        '''Rebuild search index in background if model was changed, unless tags tree is built (it is started after)'''
+        if not self.search or self.search.isCurrent() or self.tagsModel.builder: return
+        if self.searchBuilder and self.searchBuilder.isRunning(): return
+        self.searchBuilder = SearchIndexBuilder(self.search)
+        self.searchBuilder.finished.connect(self.searchIndexBuilt)
+        self.searchBuilder.start(QThread.Priority.LowPriority)
+
+    def searchIndexBuilt(self):
+        if self.ui.edtModelSearch.hasFocus() and self.ui.edtModelSearch.text():
+            self.modelSearchEdited(self.ui.edtModelSearch.text()) # results of rebuilt index
+
+    def stopSearchBuilder(self):
+        if self.searchBuilder:
+            self.searchBuilder.cancel()
+            self.searchBuilder.wait()
+            self.searchBuilder = None
+
+    def modelSearchEdited(self, text):
+        if not self.search: return
+        # index is never built here, it could take seconds on large models
+        self.searchResults = self.search.find(text, stale=True)
+        self.searchModel.setStringList([self.search.describe(target) for target in self.searchResults])
+        if self.searchResults:
+            self.searchCompleter.complete()
+        if not self.search.isCurrent():
+            self.startSearchBuilder()
+
+    def modelSearchActivated(self, index: QModelIndex):
+        if not self.search or index.row() not in range(0, len(self.searchResults)): return
+        tag_idx, item_idx, field_name = self.searchResults[index.row()]
+        tag = self.m3.tags[tag_idx]
+        tree_index = self.tagsModel.findTagItem(tag, item_idx)
+        if tree_index.isValid():
+            self.ui.tagsTree.setCurrentIndex(tree_index)
+            self.ui.tagsTree.scrollTo(tree_index)
+        shadow = tree_index.data(TagTreeModel.TagTreeShadowRole) if tree_index.isValid() else None # type: ShadowItem
+        if not shadow or shadow.tag is not tag or shadow.tag_item != item_idx:
+            # item has no row in tree, e.g. value of simple tag
+            self.treeTagSelected(tag, item_idx)
+            if item_idx >= 0 and tag.info.simple:
+                self.fieldsModel.navigate(item_idx)
+        field = tag.info.fieldsByName.get(field_name) if field_name else None
+        if field:
+            field_index = self.fieldsFilterModel.mapFromSource(self.fieldsModel.fieldIndex(field))
+            if field_index.isValid():
+                self.ui.fieldsTable.setCurrentIndex(field_index)
+                self.ui.fieldsTable.scrollTo(field_index)
+
     def treeTagSelected(self, tag, item = -1):
         self.fieldsModel.setM3Tag(tag, item)
 
@@ -157,6 +233,11 @@ class mainWin(QtWidgets.QMainWindow):
     ## EVENTS ##
 
     def fieldDoubleClick(self, index: QModelIndex):
+        if self.tagsModel.builder:
+            # builder thread reads model, m3File refuses changes until tree is built
+            self.ui.statusbar.showMessage('Model can be edited when tags tree is built', 3000)
+            return
+        self.stopSearchBuilder() # index is built again on next search
         tag = self.fieldsModel.tag
         if index.isValid() and tag:
             f = index.data(fieldsTableModel.FieldRole) # type: m3FieldInfo
@@ -188,18 +269,29 @@ class mainWin(QtWidgets.QMainWindow):
         fname, filter = fd.getOpenFileName(self, 'Open m3 model', self.lastFile, "M3 Model (*.m3 *.m3a)")
         if os.path.exists(fname):
             self.lastFile =  fname
-            self.m3 = m3File(fname, self.struct)
-            self.tagsModel.changeM3(self.m3)
-            self.treeTagSelected(self.m3.modl)
-            self.ui.gl3dView.setM3(self.m3)
-            self.setWindowTitle(f'M3 Editor - {fname}')
-            self.ui.actionReopen.setEnabled(True)
-            self.ui.actionSave.setEnabled(True)
-            self.ui.actionSave_as.setEnabled(True)
-            self.confirmSave = True
+            self.loadM3(fname)
+
+    def loadM3(self, fname):
+        m3prof.reset()
+        self.stopSearchBuilder()
+        self.m3 = m3File(fname, self.struct, options.getOptionBool(options.OPT_MMAP_LOADING, False))
+        self.tagsModel.changeM3(self.m3, options.getOptionBool(options.OPT_TREE_BACKGROUND_BUILD, True))
+        self.treeTagSelected(self.m3.modl)
+        self.ui.gl3dView.setM3(self.m3)
+        self.search = m3ModelSearch(self.m3)
+        if not self.tagsModel.builder: # otherwise started when tags tree is built
+            QTimer.singleShot(0, self.startSearchBuilder)
+        self.showProfile('open', [m3prof.STAGE_FILE_READ, m3prof.STAGE_REF_GRAPH, m3prof.STAGE_SHADOW_TREE, m3prof.STAGE_GL_UPLOAD])
+        self.setWindowTitle(f'M3 Editor - {fname}')
+        self.ui.actionReopen.setEnabled(True)
+        self.ui.actionSave.setEnabled(True)
+        self.ui.actionSave_as.setEnabled(True)
+        self.confirmSave = True
 
     def reopenM3(self):
-        self.m3.reloadFromData()
+        # saving doesn't rebuild m3File.data anymore, so reopen reads the file again
+        if os.path.exists(self.lastFile):
+            self.loadM3(self.lastFile)
 
     def saveM3(self):
         if self.confirmSave and os.path.exists(self.lastFile):
@@ -210,10 +302,32 @@ class mainWin(QtWidgets.QMainWindow):
             if ret == mb.StandardButton.No:
                 self.saveM3as()
                 return
-        self.m3.repackIntoData()
-        with open(self.lastFile, 'wb') as file:
-            file.write(self.m3.data)
-            file.close()
+        self.m3.save(self.lastFile)
+        self.showProfile('save', [m3prof.STAGE_SAVE])
+
+    def setProfiling(self, on: bool):
+        m3prof.enable(on)
+        m3prof.reset()
+        self.ui.actionProfiling.setChecked(on)
+        self.ui.actionSaveProfile.setEnabled(on)
+        self.ui.lblProfile.clear()
+
+    def showProfile(self, action, stages):
+        if not m3prof.enabled: return
+        self.ui.lblProfile.setText(f'{action}: {m3prof.summary(stages)}')
+        self.ui.lblProfile.setToolTip(m3prof.details())
+
+    def saveProfile(self):
+        fname, filter = fd.getSaveFileName(self, 'Save profiling data', 'profile.json', "JSON (*.json)")
+        if fname:
+            m3prof.dumpJson(fname)
+
+    def showMemoryReport(self):
+        if not hasattr(self, 'm3'): return
+        text = formatReport(memoryReport(self.m3, self.tagsModel.shadows, self.ui.gl3dView))
+        box = mb(mb.Icon.Information, 'Memory Report', text.split('\n', 1)[0], mb.StandardButton.Ok, self)
+        box.setDetailedText(text)
+        box.exec()
 
     def saveM3as(self):
         fname, filter = fd.getSaveFileName(self, 'Save m3 model', self.lastFile, "M3 Model (*.m3);;M3 Model Animations (*.m3a)")
@@ -227,6 +341,8 @@ class mainWin(QtWidgets.QMainWindow):
         self.saveM3()
 
     def closeEvent(self, ev: QtGui.QCloseEvent) -> None:
+        self.tagsModel.stopBuilder()
+        self.stopSearchBuilder()
         options.saveIni()
         ev.accept()
 
@@ -14,12 +14,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
-from typing import List, Tuple
-from struct import pack, pack_into, unpack_from, calcsize
-from m3struct import m3FieldInfo, m3StructFile, m3StructInfo, m3Type,\
-    TAG_HEADER_33, TAG_HEADER_34, TAG_HEADER_VER, TAG_CHAR, BINARY_DATA_ITEM_BYTES_COUNT
+from typing import Dict, Iterable, Iterator, List, Tuple
+from struct import pack, pack_into, unpack_from, iter_unpack, calcsize, Struct, error as struct_error
+from array import array
+from m3struct import m3FieldInfo, m3StructFile, m3Type, getNumpy, m3TagToStr,\
+    TAG_HEADER_33, TAG_HEADER_34, TAG_HEADER_VER, TAG_CHAR, BINARY_DATA_ITEM_BYTES_COUNT, IDX_SIMPLE, DEFAULT_STRUCT_FILE
 from common import ceildiv, getTagStepNeededBytes, fixed8_to_float, fixed16_to_float
-import m3
+import m3, m3prof, mmap, bisect, os, shutil, sys, tempfile, threading
 
 INDEX_REF_SIZE = calcsize('<IIII') # tag, dataOffset, dataCount, version
 # index item fields, first 3 also match header fields
@@ -39,15 +40,25 @@ REF_FROM_ITEM = 1
 REF_FROM_FIELD = 2
 REF_FROM_OFFSET = 3
 
+NO_REFS = () # shared result of m3File.getRefsTo() for items without references
+DISPLAY_CACHE_SIZE = 10000 # cached texts per tag, cache of tag is cleared when it gets larger
+PATCH_MAX_FILE_PART = 0.25 # file is saved whole instead of patched when dirty tags take larger part of it
+
 SIZE_TO_FORMAT = {1: '<B', 2: '<H', 4: '<I'}
+SIZE_TO_STRUCT = {size: Struct(fmt) for size, fmt in SIZE_TO_FORMAT.items()}
+REF_STRUCT = Struct('<III') # count, index, flags(not used)
+REF_SMALL_STRUCT = Struct('<II') # count, index
+HEADER_STRUCT = Struct('<IIIIII') # header tag, tag index offset, tag index item count, MODL ref (count, index, flags)
+INDEX_STRUCT = Struct('<IIII') # tag, dataOffset, dataCount, version
 
 class m3FileError(Exception):
     pass
 
 class m3Tag():
-    def __init__(self, file: m3File, data: bytearray, index: int, tag: int, count: int, ver: int):
+    def __init__(self, file: m3File, data: bytearray | memoryview, index: int, tag: int, count: int, ver: int):
         self.file = file
         self.data = data
+        ''' bytearray or read-only memoryview into mapped file, use getWritableData() before modifying it '''
         self.idx = index
         self.tag = tag
         self.count = count
@@ -55,23 +66,44 @@ class m3Tag():
         # the count property may change when parsing vflags and making vertex structure
         self.type_count = count
         self.ver = ver
-        self.info = m3StructInfo(tag, ver, file.structs)
-        self.refFrom = [] # type: List[Tuple]
-        ''' RefFromTuple( tag_index, item_index, field_name, ref_data_absolute_offset) '''
+        self.info = file.structs.getStructInfo(tag, ver)
         #if tag==m3struct.TAG_CHAR: pass
             # special case, 'data' contains a string of 'count-1' length + null-terminator (C string)
             # still, we should not decode it here, CHAR tag can contain binary data of unkown format (see MADD tag in structures.xml)
             # decoding should only happen after all references are resolved and it is certain 'data' content is a string
 
+    @property
+    def refFrom(self) -> List[Tuple]:
+        ''' RefFromTuple( tag_index, item_index, field_name, ref_data_absolute_offset) '''
+        return self.file.refFrom[self.idx]
+
     def addRefFrom(self, tag_index, item_index, field: m3FieldInfo):
-        if tag_index>0:
-            self.refFrom.append((tag_index, item_index, field.name, field.getDataOffset(item_index)))
-            if field.refToBinary:
-                self.info.forceBinary()
+        self.file.addRefFrom(self.idx, tag_index, item_index, field)
+
+    def getRefsTo(self, item_idx) -> List[Tuple[m3FieldInfo, int]]:
+        return self.file.getRefsTo(self.idx, item_idx)
+
+    def forceBinary(self):
+        self.info = self.file.structs.getBinaryStructInfo(self.tag, self.ver)
+        self.file.displayCache.pop(self.idx, None)
+
+    def forceVertices(self, vflags: int):
+        self.info = self.file.structs.getVertexStructInfo(self.tag, self.ver, vflags)
+        self.count = self.type_count // self.info.item_size
+        self.file.displayCache.pop(self.idx, None)
+
+    def getWritableData(self) -> bytearray:
+        '''Return tag data as bytearray, data that still references mapped file is copied on first call'''
+        self.file.checkWritable()
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
+            m3prof.count(m3prof.CNT_BYTES_COPIED, len(self.data))
+        self.file.markDirty(self.idx)
+        return self.data
 
     def getStr(self) -> str:
         if self.info.type == m3Type.CHAR:
-            return self.data[:self.count-1].decode()
+            return bytes(self.data[:self.count-1]).decode()
         else:
             return ''
 
@@ -80,16 +112,19 @@ class m3Tag():
 
     def setStr(self, value: str):
         if self.info.type == m3Type.CHAR:
+            self.file.checkWritable()
             old_count = self.count
+            old_size = len(self.data)
             self.data = bytearray(value, 'utf-8') + b'\x00'
             self.count = len(self.data)
             self.type_count = len(self.data)
             need = getTagStepNeededBytes(self.count)
             if need: self.data += b'\xaa'*need
+            self.file.markDirty(self.idx, old_count != self.count or old_size != len(self.data))
             if old_count != self.count:
                 for ref in self.refFrom: # update count in tags referencing this CHAR tag
                     tag = self.file.tags[ref[REF_FROM_TAG]]
-                    pack_into('<I', tag.data, ref[REF_FROM_OFFSET], self.count) # count is first uint32 in Reference structure
+                    pack_into('<I', tag.getWritableData(), ref[REF_FROM_OFFSET], self.count) # count is first uint32 in Reference structure
 
     def getItemName(self, item_idx = 0, with_prefix = True):
         if self.info.type == m3Type.CHAR:
@@ -98,8 +133,26 @@ class m3Tag():
             return (f' {self.info.item_name_field.name} -> ' if with_prefix else '') + self.getReff(item_idx, self.info.item_name_field).getItemName()
         return ''
 
+    def getCachedText(self, key, format, *args) -> str:
+        '''Return format(*args) kept in m3File.displayCache under key until this tag or tags it references are changed'''
+        cache = self.file.displayCache.get(self.idx)
+        if cache is None:
+            cache = self.file.displayCache[self.idx] = {}
+        else:
+            text = cache.get(key)
+            if text is not None: return text
+            if len(cache) >= DISPLAY_CACHE_SIZE: cache.clear()
+        text = cache[key] = format(*args)
+        return text
+
+    def getItemNameCached(self, item_idx = 0) -> str:
+        return self.getCachedText((item_idx, None), self.getItemName, item_idx)
+
+    def getFieldAsStrCached(self, item_idx, field: m3FieldInfo) -> str:
+        return self.getCachedText((item_idx, field), self.getFieldAsStr, item_idx, field)
+
     def getFieldInfoStr(self, field: m3FieldInfo):
-        if not field in self.info.fields:
+        if field.owner is not self.info:
             raise m3FileError(FIELD_NOT_PART_OF_TAG)
         if field.type == m3Type.CHAR:
             return f'Size = {self.count}'
@@ -108,17 +161,17 @@ class m3Tag():
         return field.getInfoStr()
 
     def getFieldAsStr(self, item_idx, field: m3FieldInfo) -> str:
-        if not field in self.info.fields:
+        if field.owner is not self.info:
             raise m3FileError(FIELD_NOT_PART_OF_TAG)
         if field.type == m3Type.CHAR:
             return self.getStr()
         offset = field.getDataOffset(item_idx)
         if field.isRef():
             if field.type == m3Type.REF:
-                ref = unpack_from('<III', self.data, offset) # count, index, flags(not used)
+                ref = REF_STRUCT.unpack_from(self.data, offset) # count, index, flags(not used)
                 s = f'idx={ref[1]}, cnt={ref[0]}, flag={ref[2]:x}'
             elif field.type == m3Type.REF_SMALL:
-                ref = unpack_from('<II', self.data, offset) # count, index
+                ref = REF_SMALL_STRUCT.unpack_from(self.data, offset) # count, index
                 s = f'idx={ref[1]}, cnt={ref[0]}'
             if self.refIsValid(item_idx, field):
                 refTag = self.getReff(item_idx, field)
@@ -128,8 +181,8 @@ class m3Tag():
             return s
         val = None
         if field.type in m3Type.SIMPLE:
-            val = unpack_from(m3Type.toFormat(field.type), self.data, offset)[0]
-            hex = unpack_from(m3Type.toHexFormat(field.type), self.data, offset)[0]
+            val = field.codec.unpack_from(self.data, offset)[0]
+            hex = field.hex_codec.unpack_from(self.data, offset)[0]
             if field.type == m3Type.FIXED8:
                 val = fixed8_to_float(val)
             if field.type == m3Type.FIXED16:
@@ -142,30 +195,164 @@ class m3Tag():
         return self.getBinaryAsStr(offset, field.size)
 
     def getFieldAsUInt(self, item_idx, field: m3FieldInfo) -> int:
-        if not field in self.info.fields:
+        if field.owner is not self.info:
             raise m3FileError(FIELD_NOT_PART_OF_TAG)
-        if field.size in SIZE_TO_FORMAT:
+        codec = SIZE_TO_STRUCT.get(field.size)
+        if codec:
             offset = self.info.item_size * item_idx + field.offset
-            return unpack_from(SIZE_TO_FORMAT[field.size], self.data, offset)[0]
+            return codec.unpack_from(self.data, offset)[0]
 
     def getFieldValue(self, item_idx, field: m3FieldInfo):
-        if not field in self.info.fields:
+        if field.owner is not self.info:
             raise m3FileError(FIELD_NOT_PART_OF_TAG)
-        fmt = m3Type.toFormat(field.type)
-        if fmt:
+        if field.codec:
             offset = self.info.item_size * item_idx + field.offset
-            return unpack_from(fmt, self.data, offset)[0]
+            return field.codec.unpack_from(self.data, offset)[0]
 
     def getFieldValueByName(self, item_idx, field_name: str):
         field = self.info.getFieldByName(field_name)
-        if field:
-            fmt = m3Type.toFormat(field.type)
-            if fmt:
-                offset = self.info.item_size * item_idx + field.offset
-                return unpack_from(fmt, self.data, offset)[0]
+        if field and field.codec:
+            offset = self.info.item_size * item_idx + field.offset
+            return field.codec.unpack_from(self.data, offset)[0]
+
+    def getItem(self, item_idx) -> Dict:
+        '''Decode all fields of an item into dict {field name: value}, references are (count, index[, flags]) tuples'''
+        values = self.info.item_codec.unpack_from(self.data, self.info.item_size * item_idx)
+        return {f.name: values[i] if n == 1 else values[i:i+n] for f, i, n in self.info.item_fields}
+
+    def iterItems(self, start = 0, end = None) -> Iterator[Dict]:
+        '''Decode items in range(start, end) the same way as getItem()'''
+        end = self.count if end is None else min(end, self.count)
+        if start >= end: return
+        size = self.info.item_size
+        fields = self.info.item_fields
+        for values in self.info.item_codec.iter_unpack(memoryview(self.data)[size*start:size*end]):
+            yield {f.name: values[i] if n == 1 else values[i:i+n] for f, i, n in fields}
+
+    def asArray(self, writable = False):
+        '''Return numpy structured array over tag data without copying it, fields are named as in getItem()
+
+        Array is read-only unless writable is set, in that case tag gets its own copy of data if it is still mapped from file.
+        Writes through writable array are not seen by m3File, tag is marked dirty only when array is returned.
+        Call file.markDirty(tag.idx) after writing, so that cached texts are dropped and next save() writes new values,
+        and file.rebildRefFrom() if references were changed.
+        '''
+        np = getNumpy()
+        if np is None:
+            raise m3FileError('numpy is required for array access to tag data')
+        if not self.info.item_codec:
+            raise m3FileError(f'{self.info.name}#{self.idx} has no fixed size items')
+        data = self.getWritableData() if writable else self.data
+        arr = np.frombuffer(data, dtype=self.info.getDtype(), count=self.count)
+        if not writable:
+            arr.flags.writeable = False
+        return arr
+
+    def setItem(self, item_idx, record: Dict):
+        '''Encode item fields from dict returned by getItem(), fields missing in record are not changed
+
+        Changed references update refFrom and orphans as setRef() does.
+        Record is checked before anything is written, ValueError names the first wrong field.
+        '''
+        for name in record:
+            if name not in self.info.fieldsByName:
+                raise ValueError(f'Field {name} not found in {self.info.name}#{self.idx}')
+        offset = self.info.item_size * item_idx
+        old_values = self.info.item_codec.unpack_from(self.data, offset)
+        values = list(old_values)
+        refs = [] # type: List[Tuple[m3FieldInfo, Tuple, Tuple]]
+        changed = [] # type: List[Tuple[m3FieldInfo, int, int]]
+        for f, i, n in self.info.item_fields:
+            if f.name in record:
+                value = record[f.name]
+                if n == 1:
+                    values[i] = value
+                else:
+                    if isinstance(value, (str, bytes)) or len(value) != n:
+                        raise ValueError(f'Field {f.name} of {self.info.name}#{self.idx} needs {n} values')
+                    if f.isRef():
+                        old_ref = tuple(values[i:i+2])
+                        new_ref = tuple(value[:2])
+                        if old_ref != new_ref: refs.append((f, old_ref, new_ref))
+                    values[i:i+n] = value
+                changed.append((f, i, n))
+        if len(changed) < len(record): # names of fields that are not part of item, like substructure or big binary field
+            used = {f.name for f, i, n in changed}
+            name = next(name for name in record if name not in used)
+            raise ValueError(f'Field {name} of {self.info.name}#{self.idx} can not be set by setItem()')
+        try:
+            data = self.info.item_codec.pack(*values)
+        except (struct_error, TypeError):
+            for f, i, n in changed: # encode changed fields one by one to find the wrong one
+                try:
+                    self.info.item_codec.pack(*old_values[:i], *values[i:i+n], *old_values[i+n:])
+                except (struct_error, TypeError) as e:
+                    raise ValueError(f'Field {f.name} of {self.info.name}#{self.idx}: {e}') from e
+            raise
+        self.getWritableData()[offset:offset + len(data)] = data
+        for f, old_ref, new_ref in refs:
+            self.file.updateRefFrom(self.idx, item_idx, f, old_ref, new_ref)
+
+    def getColumnField(self, field: m3FieldInfo | str) -> m3FieldInfo:
+        '''Resolve field name and check that field is a simple value of this tag'''
+        if isinstance(field, str):
+            name = field
+            field = self.info.fieldsByName.get(name)
+            if field is None:
+                raise m3FileError(f'Field name {name} not found in {self.info.name}#{self.idx}')
+        elif field.owner is not self.info:
+            raise m3FileError(FIELD_NOT_PART_OF_TAG)
+        if field.codec is None:
+            raise m3FileError(f'Field is not a simple value ({field.type_name})')
+        return field
+
+    def getColumn(self, field: m3FieldInfo | str, start = 0, end = None) -> array:
+        '''Read simple field (field info or name like "uv0.x") of items in range(start, end) into array.array
+
+        Values are raw as in getFieldValue(), numpy.asarray() of the result does not copy it.
+        '''
+        field = self.getColumnField(field)
+        end = self.count if end is None else min(end, self.count)
+        column = array(m3Type.TYPE_TO_ARRAY[field.type])
+        if start >= end: return column
+        size = self.info.item_size
+        k = field.codec.size
+        base = size * start + field.offset
+        stop = size * end
+        # strided slices of mapped data are not contiguous, bytes() makes them so
+        if k == 1:
+            column.frombytes(bytes(self.data[base:stop:size]))
+        else:
+            raw = bytearray((end - start) * k)
+            for j in range(k): # gather each byte of the value from all items at once
+                raw[j::k] = bytes(self.data[base+j:stop:size])
+            column.frombytes(raw)
+            if sys.byteorder == 'big': column.byteswap()
+        return column
+
+    def setColumn(self, field: m3FieldInfo | str, values: Iterable, start = 0):
+        '''Write values into simple field of items starting at start, values are raw as in getColumn()'''
+        field = self.getColumnField(field)
+        typecode = m3Type.TYPE_TO_ARRAY[field.type]
+        column = values if isinstance(values, array) and values.typecode == typecode else array(typecode, values)
+        n = len(column)
+        if n == 0: return
+        if start < 0 or start + n > self.count:
+            raise m3FileError(f'Column of {n} values at {start} is out of {self.info.name}#{self.idx} items ({self.count})')
+        if sys.byteorder == 'big':
+            column = array(column.typecode, column)
+            column.byteswap()
+        raw = column.tobytes()
+        size = self.info.item_size
+        k = field.codec.size
+        base = size * start + field.offset
+        stop = size * (start + n)
+        data = self.getWritableData()
+        for j in range(k):
+            data[base+j:stop:size] = raw[j::k]
 
     def getFieldUnpacked(self, item_idx, field: m3FieldInfo, unpack_format):
-        if not field in self.info.fields:
+        if field.owner is not self.info:
             raise m3FileError(FIELD_NOT_PART_OF_TAG)
         offset = self.info.item_size * item_idx + field.offset
         return unpack_from(unpack_format, self.data, offset)
@@ -186,21 +373,21 @@ class m3Tag():
         return ' '.join(data_list)
 
     def checkBitState(self, item_idx, field: m3FieldInfo) -> bool:
-        if not field in self.info.fields:
+        if field.owner is not self.info:
             raise m3FileError(FIELD_NOT_PART_OF_TAG)
-        if field.type == m3Type.BIT and field.size in SIZE_TO_FORMAT:
+        if field.type == m3Type.BIT and field.size in SIZE_TO_STRUCT:
             offset = self.info.item_size * item_idx + field.offset
-            val = unpack_from(SIZE_TO_FORMAT[field.size], self.data, offset)[0]
+            val = SIZE_TO_STRUCT[field.size].unpack_from(self.data, offset)[0]
             if val & field.bitMask == field.bitMask: return True
         return False
 
     def getReff(self, item_idx, field: m3FieldInfo) -> m3Tag:
-        if not field in self.info.fields:
+        if field.owner is not self.info:
             raise m3FileError(FIELD_NOT_PART_OF_TAG)
         if not field.isRef():
             raise m3FileError(f'Field is not a reference ({field.type_name})')
         offset = field.getDataOffset(item_idx)
-        ref = unpack_from('<II', self.data, offset) # count, index, flags(not used)
+        ref = REF_SMALL_STRUCT.unpack_from(self.data, offset) # count, index, flags(not used)
         if ref[0]>0 and ref[1] in range(1, self.file.tag_count):
             try:
                 return self.file.tags[ref[1]]
@@ -209,9 +396,9 @@ class m3Tag():
         raise m3FileError(f'Trying to get tag from null reference: {self.info.name}#{self.idx}[{item_idx}] - {field.name}')
 
     def getRefn(self, item_idx, field_name) -> m3Tag:
-        for f in self.info.fields:
-            if f.name == field_name:
-                return self.getReff(item_idx,f)
+        field = self.info.fieldsByName.get(field_name)
+        if field:
+            return self.getReff(item_idx, field)
         raise m3FileError(f'Field name {field_name} not found in {self.info.name}#{self.idx}')
 
     def getRefi(self, item_idx, field_idx) -> m3Tag:
@@ -220,109 +407,540 @@ class m3Tag():
         return self.getReff(item_idx, self.info.fields[field_idx])
 
     def refIsValid(self, item_idx, field: m3FieldInfo) -> bool:
-        if not field in self.info.fields:
+        if field.owner is not self.info:
             raise m3FileError(FIELD_NOT_PART_OF_TAG)
         if not field.isRef():
             raise m3FileError(f'Field is not a reference ({field.type_name})')
         offset = field.getDataOffset(item_idx)
-        ref = unpack_from('<II', self.data, offset) # count, index, flags(not used)
+        ref = REF_SMALL_STRUCT.unpack_from(self.data, offset) # count, index, flags(not used)
         if ref[0]>0 and ref[1] in range(1, self.file.tag_count):
             return True
         else:
             return False
 
+    def setRef(self, item_idx, field: m3FieldInfo, ref_idx: int, count: int = None):
+        '''Point reference field to tag at ref_idx (0 = null reference) and update refFrom and orphans of affected tags
+
+        If count is not set, it is taken from referenced tag.
+        '''
+        if field.owner is not self.info:
+            raise m3FileError(FIELD_NOT_PART_OF_TAG)
+        if not field.isRef():
+            raise m3FileError(f'Field is not a reference ({field.type_name})')
+        if ref_idx not in range(0, self.file.tag_count):
+            raise m3FileError(f'Ref Index out of bounds: {self.info.name}#{self.idx}[{item_idx}] - {field.name} = {ref_idx}')
+        if count is None:
+            count = self.file.tags[ref_idx].type_count if ref_idx > 0 else 0
+        offset = field.getDataOffset(item_idx)
+        old_ref = REF_SMALL_STRUCT.unpack_from(self.data, offset)
+        REF_SMALL_STRUCT.pack_into(self.getWritableData(), offset, count, ref_idx)
+        self.file.updateRefFrom(self.idx, item_idx, field, old_ref, (count, ref_idx))
+
+class m3TagList():
+    '''Sequence of file tags, m3Tag objects are created on first access'''
+    def __init__(self, file: m3File, count: int):
+        self.file = file
+        self.items = [None] * count # type: List[m3Tag | None]
+        self.created = 0
+        ''' number of m3Tag objects created so far '''
+        self.lock = threading.RLock()
+        ''' tags may be created from background thread, e.g. uiTreeView.ShadowTreeBuilder '''
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self.items)))]
+        tag = self.items[idx]
+        if tag is None:
+            if idx < 0: idx += len(self.items)
+            with self.lock:
+                tag = self.items[idx]
+                if tag is None: # not created by other thread while waiting for lock
+                    tag = self.file.createTag(idx)
+                    self.items[idx] = tag
+                    self.created += 1
+        return tag
+
+    def __iter__(self):
+        for idx in range(0, len(self.items)):
+            yield self[idx]
+
+    def isCreated(self, idx) -> bool:
+        return self.items[idx] is not None
+
+    def getCreated(self) -> List[m3Tag]:
+        return [tag for tag in self.items if tag is not None]
+
+def packFileLayout(entries: Iterable[Tuple[int, int, int, int]], tag_count, modl_idx) -> Tuple[bytes, bytearray, int]:
+    '''Build file header and tag index, entries are (tag, count, version, data size) of all tags after the header tag
+
+    Tag data is written right after the header in the same order and the index follows it.
+    Return (file header, tag index, total file size).
+    '''
+    offset = HEADER_STRUCT.size # file header == header tag at idx = 0
+    extra = getTagStepNeededBytes(offset)
+    offset += extra
+    index = bytearray(INDEX_REF_SIZE * tag_count)
+    INDEX_STRUCT.pack_into(index, 0, TAG_HEADER_34, 0, 1, TAG_HEADER_VER) # tag, dataOffset, dataCount, version
+    for idx, (tag, count, ver, size) in enumerate(entries, 1):
+        INDEX_STRUCT.pack_into(index, INDEX_REF_SIZE * idx, tag, offset, count, ver)
+        offset += size
+    header = HEADER_STRUCT.pack(
+        TAG_HEADER_34, offset, tag_count, 1, modl_idx, 0
+    ) + b'\xaa'*extra # header tag, tag index offset, tag index item count, MODL ref (count, index, flags)
+    return header, index, offset + len(index)
+
 class m3File():
-    def __init__(self, fileName, structFile: m3StructFile):
+    def __init__(self, fileName, structFile: m3StructFile, useMmap = False):
         self.structs = structFile
-        with open(fileName,'rb') as file:
-            self.data = bytearray(file.read())
+        self.fileName = os.path.abspath(fileName)
+        self.mmap = None # type: mmap.mmap | None
+        self.readers = 0
+        ''' background tasks reading model, it can't be changed while there are any, see beginRead() '''
+        self.readersLock = threading.Lock()
+        self.refsLock = threading.Lock()
+        ''' held while references are found on first access to refFrom, that may happen in background thread '''
+        with open(fileName,'rb') as file, m3prof.stage(m3prof.STAGE_FILE_READ):
+            if useMmap:
+                # tags will hold memoryview windows into mapped file instead of own copies of data
+                self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.data = memoryview(self.mmap)
+            else:
+                self.data = bytearray(file.read())
+                m3prof.count(m3prof.CNT_BYTES_READ, len(self.data))
             file.close()
         if not self.reloadFromData():
             raise m3FileError('M3 file header not found in file: '+fileName)
+        self.fileStat = self.statFile(fileName)
+
+    def beginRead(self):
+        '''Register task reading model from other thread, until endRead() every change raises m3FileError'''
+        with self.readersLock:
+            self.readers += 1
+
+    def endRead(self):
+        with self.readersLock:
+            self.readers -= 1
+
+    def checkWritable(self):
+        '''Raise m3FileError if model is read by background task, called by every method changing model'''
+        if self.readers:
+            raise m3FileError('Model is read by background task and can not be changed now')
 
     def reloadFromData(self) -> bool:
-        self.tags = [] # type: List[m3Tag]
-        self.orphans = []
+        self.checkWritable()
+        self.tags = m3TagList(self, 0)
+        self._refFrom = None # type: List[List[Tuple]] | None
+        self._orphans = [] # type: List[int]
         self.modl = None # type: m3Tag | None
         self.vert = None # type: m3Tag | None
         # reading header
         h = unpack_from('<IIIIII',self.data) # header tag, tag index offset, tag index item count, MODL ref (count, index, flags)
         if h[IDX_TAG]==TAG_HEADER_33 or h[IDX_TAG]==TAG_HEADER_34:
             self.tag_count = h[IDX_COUNT]
-            index = self.data[h[IDX_OFFSET]:]
-            items = []
-            for i in range(0,self.tag_count):
-                items.append(unpack_from('<IIII',index,INDEX_REF_SIZE*i)) # tag, dataOffset, dataCount, version
-            for i in range(0,self.tag_count):
-                offset = items[i][IDX_OFFSET]
-                if i==(self.tag_count-1):
-                    endOffset = h[IDX_OFFSET]
-                else:
-                    endOffset = items[i+1][IDX_OFFSET]
-                self.tags.append(m3Tag(self, self.data[offset:endOffset], i, items[i][IDX_TAG], items[i][IDX_COUNT], items[i][IDX_VER]))
+            self.index_offset = h[IDX_OFFSET]
+            # only index is parsed here, m3Tag objects are created by m3TagList on first access
+            index_end = self.index_offset + INDEX_REF_SIZE * self.tag_count
+            with m3prof.stage(m3prof.STAGE_INDEX_PARSE):
+                self.index = list(iter_unpack('<IIII', self.data[self.index_offset:index_end])) # type: List[Tuple[int, int, int, int]]
+                ''' tag, dataOffset, dataCount, version '''
+            self.displayCache = {} # type: Dict[int, Dict[Tuple[int, m3FieldInfo | None], str]]
+            ''' displayCache[tag_index][(item_index, field)] is text of field value or item name (field is None) shown in editor '''
+            self.refTo = {} # type: Dict[int, Dict[int, List[Tuple[m3FieldInfo, int]]]]
+            ''' refTo[tag_index][item_index] is list of (field, referenced tag index) of valid references in field order, tags are added by getTagRefsTo() '''
+            self.binaryTags = set()
+            self.dirty = set()
+            ''' indices of tags with changed data since last load or save '''
+            self.changes = 0
+            ''' number of markDirty() calls, lets caches built from tag data notice any change '''
+            self.layoutChanged = False
+            self.fileOffsets = [item[IDX_OFFSET] for item in self.index]
+            self.fileIndexOffset = self.index_offset
+            self.fileStat = None # data may not match any file, m3File.__init__ and saving set it
+            self.tags = m3TagList(self, self.tag_count)
             self.modl = self.tags[h[IDX_REF_MODL_INDEX]]
             self.vflags = self.modl.getFieldAsUInt(0, self.modl.info.getFieldByName(m3.MODL.vFlags))
-            self.rebildRefFrom()
+            self.findFormatRefs()
             return True
         else:
             return False
-    
+
+    def createTag(self, idx) -> m3Tag:
+        if m3prof.enabled:
+            with m3prof.stage(m3prof.STAGE_TAG_CREATE):
+                tag = self.newTag(idx)
+            m3prof.count(m3prof.CNT_TAGS_CREATED)
+            if isinstance(tag.data, bytearray): m3prof.count(m3prof.CNT_BYTES_COPIED, len(tag.data))
+            return tag
+        return self.newTag(idx)
+
+    def newTag(self, idx) -> m3Tag:
+        item = self.index[idx]
+        offset = item[IDX_OFFSET]
+        if idx==(self.tag_count-1):
+            endOffset = self.index_offset
+        else:
+            endOffset = self.index[idx+1][IDX_OFFSET]
+        tag = m3Tag(self, self.data[offset:endOffset], idx, item[IDX_TAG], item[IDX_COUNT], item[IDX_VER])
+        if idx in self.binaryTags:
+            tag.forceBinary()
+        return tag
+
+    @property
+    def refFrom(self) -> List[List[Tuple]]:
+        '''refFrom[tag_index] is list of references to tag, all references are found by rebildRefFrom() on first access'''
+        if self._refFrom is None:
+            with self.refsLock:
+                if self._refFrom is None: # not found by other thread while waiting for lock
+                    self.rebildRefFrom()
+        return self._refFrom
+
+    @property
+    def orphans(self) -> List[int]:
+        '''Ascending indices of tags not referenced from other tags, except header and MODL'''
+        self.refFrom # orphans are found with references
+        return self._orphans
+
+    def findFormatRefs(self):
+        '''Find vertices tag and binary CHAR tags, their layout depends on references to them, without finding all references'''
+        for tag_idx in range(1, self.tag_count):
+            if not self.tagMayHaveRefs(tag_idx): continue
+            item = self.index[tag_idx]
+            fields = [f for f in self.structs.getStructInfo(item[IDX_TAG], item[IDX_VER]).ref_fields if f.refToBinary or f.refToVertices]
+            if not fields: continue
+            tag = self.tags[tag_idx]
+            for item_idx in range(min(tag.count, len(tag.data) // tag.info.item_size)):
+                for f in fields:
+                    ref = REF_SMALL_STRUCT.unpack_from(tag.data, f.getDataOffset(item_idx))
+                    if self.isValidRef(ref):
+                        self.setRefFormat(tag_idx, f, ref[1])
+
+    def setRefFormat(self, tag_index, field: m3FieldInfo, ref_idx):
+        '''Force layout of referenced tag if field references binary data or vertices'''
+        if field.refToBinary:
+            self.binaryTags.add(ref_idx)
+            if self.tags.isCreated(ref_idx):
+                self.tags[ref_idx].forceBinary()
+        if field.refToVertices and tag_index == self.modl.idx:
+            self.vert = self.tags[ref_idx]
+            self.vert.forceVertices(self.vflags)
+
+    def tagIndices(self, tag: int) -> List[int]:
+        '''Return indices of all tags with given tag id, m3Tag objects are not created'''
+        return [i for i in range(0, self.tag_count) if self.index[i][IDX_TAG] == tag]
+
+    def tagMayHaveRefs(self, idx) -> bool:
+        '''Check if tag at index can contain references without creating m3Tag object'''
+        struct = self.structs.ByTag(self.index[idx][IDX_TAG])
+        return True if struct and not struct[IDX_SIMPLE] else False
+
+    def addRefFrom(self, ref_idx, tag_index, item_index, field: m3FieldInfo):
+        if tag_index>0:
+            self.refFrom[ref_idx].append((tag_index, item_index, field.name, field.getDataOffset(item_index)))
+            self.addRefTo(tag_index, item_index, field, ref_idx)
+            self.setRefFormat(tag_index, field, ref_idx)
+
+    def addRefTo(self, tag_index, item_index, field: m3FieldInfo, ref_idx):
+        items = self.refTo.get(tag_index)
+        if items is None: return # references are read with the rest when tag is added
+        refs = items.get(item_index)
+        if refs is None:
+            items[item_index] = [(field, ref_idx)]
+            return
+        pos = len(refs)
+        while pos > 0 and refs[pos-1][0].index > field.index:
+            pos -= 1
+        refs.insert(pos, (field, ref_idx))
+
+    def removeRefTo(self, tag_index, item_index, field: m3FieldInfo):
+        items = self.refTo.get(tag_index)
+        refs = items.get(item_index) if items else None
+        if not refs: return
+        for i, r in enumerate(refs):
+            if r[0].name == field.name:
+                del refs[i]
+                break
+        if not refs:
+            del items[item_index]
+
+    def getTagRefsTo(self, tag_index) -> Dict[int, List[Tuple[m3FieldInfo, int]]]:
+        '''refTo of one tag, its references are decoded on first call, so that only tags shown in tree pay for it'''
+        items = self.refTo.get(tag_index)
+        if items is None:
+            items = {} # filled before it is added, tree builder thread may read refTo at the same time
+            if tag_index > 0 and self.tagMayHaveRefs(tag_index):
+                tag = self.tags[tag_index]
+                info = tag.info
+                if info.ref_codec:
+                    count = min(tag.count, len(tag.data) // info.item_size)
+                    fields = info.ref_fields
+                    for idx, refs in enumerate(info.ref_codec.iter_unpack(memoryview(tag.data)[:count * info.item_size])):
+                        valid = [(f, ref_idx) for f, ref_count, ref_idx in zip(fields, refs[0::2], refs[1::2]) if ref_count>0 and 0 < ref_idx < self.tag_count]
+                        if valid: items[idx] = valid
+            self.refTo[tag_index] = items
+        return items
+
+    def getRefsTo(self, tag_index, item_index) -> List[Tuple[m3FieldInfo, int]]:
+        '''Valid references of item as (field, referenced tag index) in field order'''
+        return self.getTagRefsTo(tag_index).get(item_index, NO_REFS)
+
+    def isValidRef(self, ref) -> bool:
+        '''Check (count, index) pair of reference'''
+        return ref[0]>0 and 0 < ref[1] < self.tag_count
+
+    def updateRefFrom(self, tag_index, item_index, field: m3FieldInfo, old_ref, new_ref):
+        '''Update refFrom and orphans after one reference field changed from old_ref to new_ref (count, index)'''
+        self.checkWritable()
+        if tag_index == 0: return
+        if self._refFrom is None:
+            # references were not found yet, they will be read from data that already holds new_ref
+            self.refTo.pop(tag_index, None)
+            if self.isValidRef(new_ref):
+                self.setRefFormat(tag_index, field, new_ref[1])
+            return
+        if self.isValidRef(old_ref):
+            refs = self.refFrom[old_ref[1]]
+            for i, r in enumerate(refs):
+                if r[REF_FROM_TAG]==tag_index and r[REF_FROM_ITEM]==item_index and r[REF_FROM_FIELD]==field.name:
+                    del refs[i]
+                    break
+            self.removeRefTo(tag_index, item_index, field)
+            if len(refs)==0 and old_ref[1] != self.modl.idx:
+                pos = bisect.bisect_left(self.orphans, old_ref[1])
+                if pos == len(self.orphans) or self.orphans[pos] != old_ref[1]:
+                    self.orphans.insert(pos, old_ref[1])
+        if self.isValidRef(new_ref):
+            self.addRefFrom(new_ref[1], tag_index, item_index, field)
+            pos = bisect.bisect_left(self.orphans, new_ref[1])
+            if pos < len(self.orphans) and self.orphans[pos] == new_ref[1]:
+                del self.orphans[pos]
+
+    @m3prof.profiled(m3prof.STAGE_REF_GRAPH)
     def rebildRefFrom(self):
-        for tag in self.tags:
-            tag.refFrom.clear()
-        for tag in self.tags:
-            for idx in range(0, tag.count):
-                for f in tag.info.fields:
-                    if f.notSelfField and f.isRef() and tag.refIsValid(idx, f):
-                        ref_tag = tag.getReff(idx, f)
-                        ref_tag.addRefFrom(tag.idx, idx, f)
-                        if f.refToVertices and tag == self.modl:
-                            ref_tag.info.forceVertices(self.structs, self.vflags)
-                            ref_tag.count = ref_tag.type_count // ref_tag.info.item_size
-                            self.vert = ref_tag
-        self.orphans.clear()
-        for tag in self.tags:
-            if len(tag.refFrom)==0 and tag != self.modl and tag.idx != 0: # exclude MODL and header tags
-                self.orphans.append(tag.idx)
+        '''Find all references by reading reference fields of all tags, refFrom and orphans are replaced'''
+        refFrom = [[] for i in range(0, self.tag_count)] # type: List[List[Tuple]]
+        self.refTo.clear()
+        for tag_idx in range(1, self.tag_count):
+            # tags of simple types (CHAR, U16_, REAL, etc.) are skipped without creating them
+            if not self.tagMayHaveRefs(tag_idx): continue
+            tag = self.tags[tag_idx]
+            info = tag.info
+            if not info.ref_codec: continue
+            # ref_codec decodes (count, index) of all reference fields for each item in one call
+            count = min(tag.count, len(tag.data) // info.item_size)
+            m3prof.count(m3prof.CNT_ITEMS_SCANNED, count)
+            fields = info.ref_fields
+            for idx, refs in enumerate(info.ref_codec.iter_unpack(memoryview(tag.data)[:count * info.item_size])):
+                for f, ref_count, ref_idx in zip(fields, refs[0::2], refs[1::2]):
+                    if ref_count>0 and 0 < ref_idx < self.tag_count:
+                        refFrom[ref_idx].append((tag_idx, idx, f.name, f.getDataOffset(idx)))
+                        self.setRefFormat(tag_idx, f, ref_idx)
+        # exclude header tag and MODL
+        self._orphans = [idx for idx in range(1, self.tag_count) if len(refFrom[idx])==0 and idx != self.modl.idx]
+        self._refFrom = refFrom
+
+    def releaseMapping(self):
+        '''Copy data of tags that still reference mapped file and close the mapping'''
+        if self.mmap is None: return
+        self.checkWritable()
+        for tag in self.tags.getCreated():
+            if not isinstance(tag.data, bytearray):
+                tag.data = bytearray(tag.data)
+        if isinstance(self.data, memoryview):
+            data = bytearray(self.data)
+            self.data.release()
+            self.data = data
+        self.mmap.close()
+        self.mmap = None
+
+    def tagBuffer(self, idx):
+        '''Return data of tag at index without creating m3Tag object, created tags return their own data'''
+        tag = self.tags.items[idx]
+        if tag is not None:
+            return tag.data
+        offset = self.index[idx][IDX_OFFSET]
+        if idx==(self.tag_count-1):
+            endOffset = self.index_offset
+        else:
+            endOffset = self.index[idx+1][IDX_OFFSET]
+        return memoryview(self.data)[offset:endOffset]
+
+    def packLayout(self) -> Tuple[bytes, bytearray, int]:
+        '''Compute offsets of all tags from their current sizes, return (file header, tag index, total file size)'''
+        def entries():
+            for idx in range(1, self.tag_count): # skip tag at idx = 0 (header)
+                tag = self.tags.items[idx]
+                if tag is None:
+                    item = self.index[idx]
+                    yield item[IDX_TAG], item[IDX_COUNT], item[IDX_VER], len(self.tagBuffer(idx))
+                else:
+                    yield tag.tag, tag.type_count, tag.ver, len(tag.data)
+        return packFileLayout(entries(), self.tag_count, self.modl.idx)
+
+    @m3prof.profiled(m3prof.STAGE_SAVE)
+    def saveToFile(self, fileName):
+        '''Write file header, tag data and tag index into temporary file and atomically replace target with it
+
+        Tags that were never accessed are copied from loaded data.
+        '''
+        fileName = os.path.abspath(fileName)
+        if self.mmap is not None and os.name == 'nt' and self.isSameFile(fileName):
+            # mapped file can't be replaced on Windows
+            self.releaseMapping()
+        header, index, size = self.packLayout()
+        fd, tmpName = tempfile.mkstemp(prefix=os.path.basename(fileName)+'.', suffix='.tmp', dir=os.path.dirname(fileName))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(header)
+                for idx in range(1, self.tag_count):
+                    file.write(self.tagBuffer(idx))
+                file.write(index)
+                file.flush()
+                os.fsync(file.fileno())
+            if os.path.exists(fileName):
+                shutil.copymode(fileName, tmpName)
+            os.replace(tmpName, fileName)
+        except BaseException:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+        self.fileName = fileName
+        self.fileOffsets = [item[IDX_OFFSET] for item in INDEX_STRUCT.iter_unpack(index)]
+        self.fileIndexOffset = size - len(index)
+        self.dirty.clear()
+        self.layoutChanged = False
+        self.fileStat = self.statFile(fileName)
+        m3prof.count(m3prof.CNT_BYTES_WRITTEN, size)
+        return size
+
+    def canPatchFile(self, fileName) -> bool:
+        '''Check if changes can be written into file in place: target is the file this layout was loaded from or saved to, it was not modified since,
+        no tag changed its size or count and dirty tags are at most PATCH_MAX_FILE_PART of file
+        '''
+        if self.layoutChanged or self.fileStat is None:
+            return False
+        if not self.isSameFile(fileName) or self.statFile(fileName) != self.fileStat:
+            return False
+        size = 0
+        for idx in self.dirty:
+            tag_size = self.fileTagEnd(idx) - self.fileOffsets[idx]
+            if len(self.tagBuffer(idx)) != tag_size:
+                return False
+            size += tag_size
+        return size <= self.fileStat[0] * PATCH_MAX_FILE_PART
+
+    @m3prof.profiled(m3prof.STAGE_SAVE)
+    def patchFile(self, fileName):
+        '''Write data of dirty tags at their offsets in file, use only if canPatchFile() returned True
+
+        Whole tags are written, even if only one item changed. Patch is not atomic,
+        if it is interrupted the file is left with only some of the tags written.
+        '''
+        with open(fileName, 'r+b') as file:
+            for idx in sorted(self.dirty):
+                file.seek(self.fileOffsets[idx])
+                m3prof.count(m3prof.CNT_BYTES_WRITTEN, file.write(self.tagBuffer(idx)))
+            file.flush()
+            os.fsync(file.fileno())
+        self.dirty.clear()
+        self.fileStat = self.statFile(fileName)
+
+    def save(self, fileName, patch = False) -> bool:
+        '''Save changes into file with saveToFile(), return True if file was patched instead
+
+        With patch set, dirty tags are written into file in place when canPatchFile() allows it.
+        That is faster for small edits of large files, but unlike saveToFile() it is not atomic.
+        '''
+        if patch and self.canPatchFile(fileName):
+            self.patchFile(fileName)
+            return True
+        self.saveToFile(fileName)
+        return False
+
+    def markDirty(self, idx, layout = False):
+        '''Mark tag data as changed, layout should be set if tag size or item count changed'''
+        self.checkWritable()
+        self.dirty.add(idx)
+        self.changes += 1
+        if layout: self.layoutChanged = True
+        if self.displayCache: self.dropDisplayCache(idx)
+
+    def dropDisplayCache(self, idx):
+        '''Drop cached texts of tag and of tags referencing it directly or through other tags, they may show its value'''
+        stack = [idx]
+        seen = {idx}
+        while stack:
+            i = stack.pop()
+            self.displayCache.pop(i, None)
+            for ref in self.refFrom[i]:
+                if ref[REF_FROM_TAG] not in seen:
+                    seen.add(ref[REF_FROM_TAG])
+                    stack.append(ref[REF_FROM_TAG])
+
+    def fileTagEnd(self, idx) -> int:
+        if idx == (self.tag_count-1):
+            return self.fileIndexOffset
+        return self.fileOffsets[idx+1]
+
+    def isSameFile(self, fileName) -> bool:
+        return self.fileName is not None and os.path.exists(fileName) and os.path.exists(self.fileName) and os.path.samefile(fileName, self.fileName)
+
+    @staticmethod
+    def statFile(fileName):
+        st = os.stat(fileName)
+        return (st.st_size, st.st_mtime_ns)
 
     def repackIntoData(self):
-        idx_size =  calcsize('IIII') # tag, dataOffset, dataCount, version
-        index = bytearray(idx_size * self.tag_count)
-        pack_into('<IIII', index, 0, TAG_HEADER_34, 0, 1, TAG_HEADER_VER) # tag, dataOffset, dataCount, version
-
-        offset = calcsize('IIIIII') # file header == header tag at idx = 0
-        extra = getTagStepNeededBytes(offset)
-        self.data = bytearray(offset) + b'\xaa'*extra # file header is empty now, it will be filled last
-        offset += extra
-
-        for idx in range(1, self.tag_count): # skip tag at idx = 0 (header)
-            t = self.tags[idx]
-            pack_into('<IIII', index, idx_size * idx,
-                t.tag, offset, t.type_count, t.ver
-            ) # tag, dataOffset, dataCount, version
-            offset += len(t.data)
-            self.data += t.data
-        # put index at the end of data
-        self.data += index
-        # last: fill header info
-        pack_into('<IIIIII', self.data, 0,
-            TAG_HEADER_34, offset, self.tag_count, 1, self.modl.idx, 0
-        ) # header tag, tag index offset, tag index item count, MODL ref (count, index, flags)
+        '''Replace data with header, tags and index in current layout, tags that are not created yet are read from new data'''
+        self.checkWritable()
+        header, index, size = self.packLayout()
+        data = bytearray(size)
+        offset = len(header)
+        data[0:offset] = header
+        for idx in range(1, self.tag_count):
+            buf = self.tagBuffer(idx)
+            data[offset:offset+len(buf)] = buf
+            offset += len(buf)
+            buf = None # view into mapped file would keep releaseMapping() from closing it
+        data[offset:] = index
+        self.data = data
+        self.index = list(INDEX_STRUCT.iter_unpack(index))
+        self.index_offset = offset
+        # repacked data is usually written over the mapped file, so tags can't reference it anymore
+        self.releaseMapping()
+
+def extractStrings(m3: m3File) -> List[Tuple]:
+    '''(string, CHAR tag index, referencing tag name, tag index, item index, field name) for every reference to CHAR tags'''
+    rows = []
+    for idx in m3.tagIndices(TAG_CHAR):
+        tag = m3.tags[idx]
+        try:
+            value = tag.getStr()
+        except UnicodeDecodeError: # CHAR tags may hold binary data
+            continue
+        if not value: continue
+        if not tag.refFrom:
+            rows.append((value, idx, None, None, None, None))
+        for ref in tag.refFrom:
+            rows.append((value, idx, m3TagToStr(m3.index[ref[REF_FROM_TAG]][IDX_TAG]), ref[REF_FROM_TAG], ref[REF_FROM_ITEM], ref[REF_FROM_FIELD]))
+    return rows
 
 if __name__ == '__main__':
     #test = 'cyclone.m3'
     test = 'BeaconAttackPing_AC.m3'
     strFile = m3StructFile()
-    strFile.loadFromFile('structures.xml')
+    strFile.loadFromFile(DEFAULT_STRUCT_FILE)
     m3f = m3File(test, strFile)
     print(m3f.tag_count)
     dds = []
-    for t in m3f.tags:
-        if t.tag == TAG_CHAR:
-            s = t.data[:t.count-1].decode()
-            if s[-4:]=='.dds' and not s in dds: dds.append(s)
+    for idx in m3f.tagIndices(TAG_CHAR):
+        s = m3f.tags[idx].getStr()
+        if s[-4:]=='.dds' and not s in dds: dds.append(s)
     for s in dds:
         print(s)
+    print('tags created:', m3f.tags.created)
 
     def printTagsTree(first: m3Tag, ident, prefix):
         print('  '*ident + prefix, first.info.name, first.ver, first.count, first.getStr())
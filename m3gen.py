@@ -0,0 +1,288 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''Generator of synthetic m3 models of arbitrary size for scale testing
+
+    python m3gen.py out.m3 --bones 3000 --vertices 200000 --sequences 20 --animated-bones 500
+'''
+from typing import Dict, List
+from struct import pack_into
+from m3struct import m3StructFile, m3StructInfo, m3FieldInfo, m3TagFromName, m3Type, DEFAULT_STRUCT_FILE
+from m3file import packFileLayout, REF_SMALL_STRUCT
+from common import getTagStepNeededBytes, float_to_fixed8, float_to_fixed16
+import argparse, math, os, sys
+
+DEFAULT_VFLAGS = 0x182007d
+MODL_VERSION = 30
+
+# animation reference types, same order as sdev..sdmb references in STC_
+ANIM_TYPE_VEC3 = 2 # SD3V
+ANIM_TYPE_QUAT = 3 # SD4Q
+
+def defaultValue(f: m3FieldInfo):
+    '''Raw value of field default as it is packed by field codec'''
+    if f.type == m3Type.FIXED8:
+        return float_to_fixed8(float(f.default))
+    if f.type == m3Type.FIXED16:
+        return int(float_to_fixed16(float(f.default)))
+    if f.type in m3Type.REAL:
+        return float(f.default)
+    return int(f.default, 0)
+
+class m3ModelBuilder():
+    '''Collects tags of a new model and writes them with the same header and index layout m3File uses
+
+    New items are filled with default values of their structure fields.
+    '''
+    def __init__(self, structs: m3StructFile):
+        self.structs = structs
+        self.tags = [None] # type: List[List] # [tag, version, data, count]
+        ''' tag at index 0 is the file header, it is created when saving '''
+        self.templates = {} # type: Dict[tuple, bytes]
+
+    def getInfo(self, idx) -> m3StructInfo:
+        tag, ver, data, count = self.tags[idx]
+        return self.structs.getStructInfo(tag, ver)
+
+    def getTemplate(self, tag: int, ver: int) -> bytes:
+        '''Item data with field defaults applied'''
+        key = (tag, ver)
+        item = self.templates.get(key)
+        if item is None:
+            info = self.structs.getStructInfo(tag, ver)
+            item = bytearray(info.item_size)
+            for f in info.fields:
+                if f.default and f.codec and not f.bitMask:
+                    try:
+                        f.codec.pack_into(item, f.offset, defaultValue(f))
+                    except ValueError:
+                        pass
+            item = self.templates[key] = bytes(item)
+        return item
+
+    def addTag(self, name: str, ver: int, count: int, data: bytearray = None) -> int:
+        '''Add tag with count default items or with given data, return its index'''
+        tag = m3TagFromName(name)
+        if data is None:
+            data = bytearray(self.getTemplate(tag, ver) * count)
+        data += b'\xaa'*getTagStepNeededBytes(len(data))
+        self.tags.append([tag, ver, data, count])
+        return len(self.tags) - 1
+
+    def addStr(self, s: str) -> int:
+        data = bytearray(s, 'utf-8') + b'\x00'
+        return self.addTag('CHAR', 0, len(data), data)
+
+    def addValues(self, name: str, fmt: str, values: list) -> int:
+        '''Add tag of simple type (U16_, U32_, I32_, VEC3, QUAT...) from list of values packed with fmt, tuples are unpacked'''
+        count = len(values)
+        data = bytearray(self.structs.getStructInfo(m3TagFromName(name), 0).item_size * count)
+        step = len(data) // count if count else 0
+        for i, v in enumerate(values):
+            if isinstance(v, tuple):
+                pack_into(fmt, data, step * i, *v)
+            else:
+                pack_into(fmt, data, step * i, v)
+        return self.addTag(name, 0, count, data)
+
+    def getField(self, idx, field_name) -> m3FieldInfo:
+        return self.getInfo(idx).getFieldByName(field_name)
+
+    def setValue(self, idx, item, field_name, value):
+        f = self.getField(idx, field_name)
+        f.codec.pack_into(self.tags[idx][2], f.getDataOffset(item), value)
+
+    def setFloats(self, idx, item, field_name, *values):
+        '''Set vector/quaternion field (x, y, z[, w] floats)'''
+        f = self.getField(idx, field_name)
+        pack_into(f'<{len(values)}f', self.tags[idx][2], f.getDataOffset(item), *values)
+
+    def setRef(self, idx, item, field_name, target):
+        '''Point reference field to tag at target index, count is taken from target, empty tags are not referenced'''
+        f = self.getField(idx, field_name)
+        count = self.tags[target][3] if target else 0
+        REF_SMALL_STRUCT.pack_into(self.tags[idx][2], f.getDataOffset(item), count, target if count else 0)
+
+    def save(self, fileName, modl_idx) -> int:
+        header, index, size = packFileLayout(
+            ((tag, count, ver, len(data)) for tag, ver, data, count in self.tags[1:]), len(self.tags), modl_idx
+        )
+        with open(fileName, 'wb') as file:
+            file.write(header)
+            for t in self.tags[1:]:
+                file.write(t[2])
+            file.write(index)
+        return size
+
+def initAnimRef(b: m3ModelBuilder, idx, item, field_name, anim_id, *value):
+    '''Set animation reference header id and both init and null values'''
+    b.setValue(idx, item, field_name + '.header.id', anim_id)
+    b.setFloats(idx, item, field_name + '.initValue', *value)
+    b.setFloats(idx, item, field_name + '.nullValue', *value)
+
+def generateModel(structs: m3StructFile, bones = 100, vertices = 1000, regions = 1, sequences = 1,
+        animated_bones = 10, keys = 10, branching = 3, vflags = DEFAULT_VFLAGS) -> m3ModelBuilder:
+    '''Build model: MODL -> DIV_ -> REGN/BAT_/MSEC, BONE tree with names and IREF, vertices of given vflags,
+    SEQS with STC_/STS_/STG_ and SD3V/SD4Q keys for location and rotation of first animated_bones bones
+    '''
+    b = m3ModelBuilder(structs)
+    bones = max(1, bones)
+    # face indices are uint16 relative to first vertex of region
+    regions = max(1, min(max(regions, math.ceil(vertices / 0xFFFF)), vertices // 3 or 1))
+    animated_bones = min(animated_bones, bones)
+    modl = b.addTag('MODL', MODL_VERSION, 1)
+    b.setRef(modl, 0, 'modelName', b.addStr('SyntheticModel'))
+    b.setValue(modl, 0, 'vFlags', vflags)
+    b.setValue(modl, 0, 'numberOfBonesToCheckForSkin', bones)
+
+    # bones, every bone has unique ids of its location, rotation and scale animation references
+    bone = b.addTag('BONE', 1, bones)
+    b.setRef(modl, 0, 'bones', bone)
+    anim_ids = [] # type: List[tuple]
+    for i in range(bones):
+        b.setRef(bone, i, 'name', b.addStr(f'Bone_{i:05d}'))
+        b.setValue(bone, i, 'parent', (i - 1) // branching if i else -1)
+        ids = (0x10000 + i * 3, 0x10001 + i * 3, 0x10002 + i * 3)
+        initAnimRef(b, bone, i, 'location', ids[0], 0.0, 0.0, 0.1 if i else 0.0)
+        initAnimRef(b, bone, i, 'rotation', ids[1], 0.0, 0.0, 0.0, 1.0)
+        initAnimRef(b, bone, i, 'scale', ids[2], 1.0, 1.0, 1.0)
+        anim_ids.append(ids)
+    identity = (1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+    iref = b.addTag('IREF', 0, bones)
+    for i in range(bones):
+        pack_into('<16f', b.tags[iref][2], 64 * i, *identity)
+    b.setRef(modl, 0, 'absoluteInverseBoneRestPositions', iref)
+    lookup_count = min(bones, 256) # vertex bone lookup indices are bytes
+    b.setRef(modl, 0, 'boneLookup', b.addValues('U16_', '<H', list(range(lookup_count))))
+
+    # vertices, fields present depend on vflags
+    vinfo = structs.getVertexStructInfo(m3TagFromName('U8__'), 0, vflags)
+    vdata = bytearray(vinfo.item_size * vertices)
+    vfields = {f.name: f for f in vinfo.fields}
+    side = max(1, int(math.sqrt(vertices)))
+    normal = tuple(float_to_fixed8(v) for v in (0.0, 0.0, 1.0))
+    for i in range(vertices):
+        offset = vinfo.item_size * i
+        x, y = i % side, i // side
+        pack_into('<fff', vdata, offset + vfields['position'].offset, x * 0.1, y * 0.1, 0.0)
+        if 'boneWeight0' in vfields:
+            vdata[offset + vfields['boneWeight0'].offset] = 255
+            vdata[offset + vfields['boneLookupIndex0'].offset] = i % lookup_count
+        if 'normal' in vfields:
+            pack_into('<BBB', vdata, offset + vfields['normal'].offset, *normal)
+        if 'uv0' in vfields:
+            pack_into('<hh', vdata, offset + vfields['uv0'].offset,
+                round(float_to_fixed16(x / side)), round(float_to_fixed16(y / side)))
+    b.setRef(modl, 0, 'vertices', b.addTag('U8__', 0, len(vdata), vdata))
+
+    # one division with a region, batch and MSEC per vertex range, faces are triangles of consecutive vertices
+    div = b.addTag('DIV_', 2, 1)
+    b.setRef(modl, 0, 'divisions', div)
+    faces = []
+    regn = b.addTag('REGN', 5, regions)
+    bat = b.addTag('BAT_', 1, regions)
+    per_region = vertices // regions
+    for r in range(regions):
+        first = per_region * r
+        count = per_region if r < regions - 1 else vertices - first
+        indices = range(count // 3 * 3)
+        b.setValue(regn, r, 'firstVertexIndex', first)
+        b.setValue(regn, r, 'numberOfVertices', count)
+        b.setValue(regn, r, 'faceArrayFirstVertexIndex', len(faces))
+        b.setValue(regn, r, 'faceArrayNumberOfIndices', len(indices))
+        b.setValue(regn, r, 'numberOfBones', lookup_count)
+        b.setValue(regn, r, 'numberOfBoneLookupIndices', lookup_count)
+        b.setValue(regn, r, 'numberOfBoneWeightPairsPerVertex', 1)
+        b.setValue(bat, r, 'regionIndex', r)
+        faces.extend(indices)
+    b.setRef(div, 0, 'faces', b.addValues('U16_', '<H', faces))
+    b.setRef(div, 0, 'regions', regn)
+    b.setRef(div, 0, 'batches', bat)
+    b.setRef(div, 0, 'msec', b.addTag('MSEC', 1, 1))
+
+    # sequences, each has own transformation collection with keys for animated bones
+    if sequences > 0:
+        seqs = b.addTag('SEQS', 2, sequences)
+        stc = b.addTag('STC_', 4, sequences)
+        sts = b.addTag('STS_', 0, sequences)
+        stg = b.addTag('STG_', 0, sequences)
+        b.setRef(modl, 0, 'sequences', seqs)
+        b.setRef(modl, 0, 'sequenceTransformationCollections', stc)
+        b.setRef(modl, 0, 'sts', sts)
+        b.setRef(modl, 0, 'sequenceTransformationGroups', stg)
+        frame_ms = 33
+        for s in range(sequences):
+            name = f'Sequence_{s:03d}'
+            end = frame_ms * max(1, keys - 1)
+            b.setRef(seqs, s, 'name', b.addStr(name))
+            b.setValue(seqs, s, 'animStartInMS', 0)
+            b.setValue(seqs, s, 'animEndInMS', end)
+            b.setValue(seqs, s, 'frequency', 1)
+            b.setRef(stc, s, 'name', b.addStr(name + '_full'))
+            b.setValue(stc, s, 'stsIndex', s)
+            b.setValue(stc, s, 'stsIndexCopy', s)
+            ids, refs = [], []
+            if animated_bones:
+                sd3v = b.addTag('SD3V', 0, animated_bones)
+                sd4q = b.addTag('SD4Q', 0, animated_bones)
+                frames = [frame_ms * k for k in range(keys)]
+                for i in range(animated_bones):
+                    for sd, key_tag, values in (
+                        (sd3v, 'VEC3', [(0.0, 0.0, 0.1 + 0.01 * math.sin(k + s)) for k in range(keys)]),
+                        (sd4q, 'QUAT', [(0.0, 0.0, math.sin(0.05 * k), math.cos(0.05 * k)) for k in range(keys)]),
+                    ):
+                        b.setRef(sd, i, 'frames', b.addValues('I32_', '<i', frames))
+                        b.setRef(sd, i, 'keys', b.addValues(key_tag, '<ffff' if key_tag == 'QUAT' else '<fff', values))
+                        b.setValue(sd, i, 'fend', end)
+                    ids += [anim_ids[i][0], anim_ids[i][1]]
+                    refs += [(ANIM_TYPE_VEC3 << 16) | i, (ANIM_TYPE_QUAT << 16) | i]
+                b.setRef(stc, s, 'sd3v', sd3v)
+                b.setRef(stc, s, 'sd4q', sd4q)
+            b.setRef(stc, s, 'animIds', b.addValues('U32_', '<I', ids))
+            b.setRef(stc, s, 'animRefs', b.addValues('U32_', '<I', refs))
+            b.setRef(sts, s, 'animIds', b.addValues('U32_', '<I', ids))
+            b.setRef(stg, s, 'name', b.addStr(name))
+            b.setRef(stg, s, 'stcIndices', b.addValues('U32_', '<I', [s]))
+    b.modl = modl
+    return b
+
+def writeModel(fileName, structs: m3StructFile, **kwargs) -> int:
+    '''Generate model with generateModel() arguments and save it, return number of tags'''
+    b = generateModel(structs, **kwargs)
+    b.save(fileName, b.modl)
+    return len(b.tags)
+
+def main(argv = None) -> int:
+    parser = argparse.ArgumentParser(description='Generate synthetic m3 model')
+    parser.add_argument('output')
+    parser.add_argument('--structures', default=DEFAULT_STRUCT_FILE, help='path to structures.xml')
+    parser.add_argument('--bones', type=int, default=100)
+    parser.add_argument('--vertices', type=int, default=1000)
+    parser.add_argument('--regions', type=int, default=1)
+    parser.add_argument('--sequences', type=int, default=1)
+    parser.add_argument('--animated-bones', type=int, default=10, help='bones with location and rotation keys in every sequence')
+    parser.add_argument('--keys', type=int, default=10, help='keys per animated track')
+    parser.add_argument('--branching', type=int, default=3, help='children per bone in bone tree')
+    parser.add_argument('--vflags', type=lambda s: int(s, 0), default=DEFAULT_VFLAGS)
+    args = parser.parse_args(argv)
+    structs = m3StructFile()
+    structs.loadFromFile(args.structures)
+    count = writeModel(args.output, structs, bones=args.bones, vertices=args.vertices, regions=args.regions,
+        sequences=args.sequences, animated_bones=args.animated_bones, keys=args.keys, branching=args.branching, vflags=args.vflags)
+    print(f'{args.output}: {count} tags, {os.path.getsize(args.output)} bytes')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''Persistent SQLite index of CHAR strings in many m3 files and of fields referencing them
+
+    python m3index.py update models.m3idx -j 8 models/
+    python m3index.py find models.m3idx --suffix X.dds --tag LAYR
+    python m3index.py find models.m3idx Walk --tag SEQS --field name --refs
+
+Only files with changed size or modification time are read again by update.
+'''
+from typing import Dict, List
+from m3struct import DEFAULT_STRUCT_FILE
+from m3file import m3File, extractStrings
+from common import collectFiles
+import argparse, json, m3pool, os, sqlite3, sys
+
+INDEX_VERSION = 1
+''' increase when tables change, index of other version is rebuilt '''
+
+MATCH_EXACT = 'exact'
+MATCH_SUFFIX = 'suffix'
+MATCH_PREFIX = 'prefix'
+MATCH_CONTAINS = 'contains'
+
+SCHEMA = '''
+CREATE TABLE files(id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, size INTEGER, mtime_ns INTEGER, error TEXT);
+CREATE TABLE strings(id INTEGER PRIMARY KEY, value TEXT UNIQUE NOT NULL, rkey TEXT NOT NULL);
+CREATE INDEX strings_rkey ON strings(rkey);
+CREATE TABLE refs(file_id INTEGER NOT NULL, string_id INTEGER NOT NULL, char_idx INTEGER, tag TEXT, tag_idx INTEGER, item INTEGER, field TEXT);
+CREATE INDEX refs_string ON refs(string_id);
+CREATE INDEX refs_file ON refs(file_id);
+'''
+''' refs has one row per reference to CHAR tag, strings that are not referenced get one row with NULL tag '''
+
+def reverseKey(value: str) -> str:
+    '''Key of strings table that turns case-insensitive suffix search into indexed range search'''
+    return value.lower()[::-1]
+
+def likeEscape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def indexFile(job) -> Dict:
+    fileName, size, mtime_ns = job
+    res = {'file': fileName, 'size': size, 'mtime_ns': mtime_ns, 'rows': [], 'error': None}
+    try:
+        res['rows'] = extractStrings(m3File(fileName, m3pool.structs))
+    except Exception as e: # damaged file is recorded with error and is not read again until it changes
+        res['error'] = f'{type(e).__name__}: {e}'
+    return res
+
+class m3SearchIndex():
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.db = sqlite3.connect(fileName)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+            self.db.executescript('DROP TABLE IF EXISTS refs; DROP TABLE IF EXISTS strings; DROP TABLE IF EXISTS files;')
+            self.db.executescript(SCHEMA)
+            self.db.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+            self.db.commit()
+        self.stringIds = {} # type: Dict[str, int]
+        ''' ids of strings inserted during update '''
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def stringId(self, value: str) -> int:
+        sid = self.stringIds.get(value)
+        if sid is None:
+            row = self.db.execute('SELECT id FROM strings WHERE value = ?', (value,)).fetchone()
+            if row:
+                sid = row[0]
+            else:
+                sid = self.db.execute('INSERT INTO strings(value, rkey) VALUES (?, ?)', (value, reverseKey(value))).lastrowid
+            self.stringIds[value] = sid
+        return sid
+
+    def storeFile(self, res: Dict):
+        '''Replace indexed data of one file with result of indexFile()'''
+        row = self.db.execute('SELECT id FROM files WHERE path = ?', (res['file'],)).fetchone()
+        if row:
+            file_id = row[0]
+            self.db.execute('DELETE FROM refs WHERE file_id = ?', (file_id,))
+            self.db.execute('UPDATE files SET size = ?, mtime_ns = ?, error = ? WHERE id = ?', (res['size'], res['mtime_ns'], res['error'], file_id))
+        else:
+            file_id = self.db.execute('INSERT INTO files(path, size, mtime_ns, error) VALUES (?, ?, ?, ?)',
+                (res['file'], res['size'], res['mtime_ns'], res['error'])).lastrowid
+        self.db.executemany('INSERT INTO refs(file_id, string_id, char_idx, tag, tag_idx, item, field) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(file_id, self.stringId(r[0])) + r[1:] for r in res['rows']])
+
+    def removeFiles(self, ids: List[int]):
+        for file_id in ids:
+            self.db.execute('DELETE FROM refs WHERE file_id = ?', (file_id,))
+            self.db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def update(self, paths: List[str], structFileName = DEFAULT_STRUCT_FILE, jobs = 1, progress = None) -> Dict:
+        '''Index new and changed m3 files found in paths and forget deleted ones, returns counts of files
+
+        progress(done, total) is called after each read file if set.
+        '''
+        files = [os.path.abspath(f) for f in collectFiles(paths)]
+        roots = [os.path.join(os.path.abspath(p), '') for p in paths if os.path.isdir(p)]
+        known = {path: (file_id, size, mtime_ns) for file_id, path, size, mtime_ns in self.db.execute('SELECT id, path, size, mtime_ns FROM files')}
+        todo = []
+        for f in files:
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            old = known.get(f)
+            if old is None or old[1] != st.st_size or old[2] != st.st_mtime_ns:
+                todo.append((f, st.st_size, st.st_mtime_ns))
+        present = set(files)
+        gone = [v[0] for path, v in known.items() if path not in present and any(path.startswith(r) for r in roots)]
+        self.removeFiles(gone)
+
+        self.stringIds.clear()
+        failed = 0
+        with m3pool.mapFiles(indexFile, todo, jobs, structFileName) as results:
+            for done, res in enumerate(results, 1):
+                if res['error']: failed += 1
+                self.storeFile(res)
+                if progress: progress(done, len(todo))
+        if gone or todo:
+            self.db.execute('DELETE FROM strings WHERE id NOT IN (SELECT string_id FROM refs)')
+        self.db.commit()
+        self.stringIds.clear()
+        return {'files': len(files), 'indexed': len(todo), 'failed': failed, 'removed': len(gone), 'unchanged': len(files) - len(todo)}
+
+    def find(self, text: str, match = MATCH_EXACT, tag: str = None, field: str = None, limit = 0) -> List[Dict]:
+        '''Return references to strings matching text, tag and field filter by referencing tag name and field name
+
+        Exact match is case-sensitive, other matches are not.
+        Strings that are not referenced from any tag are found only without tag and field filters.
+        '''
+        if match == MATCH_EXACT:
+            cond, params = 's.value = ?', [text]
+        elif match == MATCH_SUFFIX:
+            key = reverseKey(text)
+            cond, params = 's.rkey >= ? AND s.rkey < ?', [key, key + '\U0010ffff']
+        elif match == MATCH_PREFIX:
+            cond, params = "s.value LIKE ? ESCAPE '\\'", [likeEscape(text) + '%']
+        elif match == MATCH_CONTAINS:
+            cond, params = "s.value LIKE ? ESCAPE '\\'", ['%' + likeEscape(text) + '%']
+        else:
+            raise ValueError(f'Unknown match mode {match}')
+        if tag:
+            cond += ' AND r.tag = ?'
+            params.append(tag)
+        if field:
+            cond += ' AND r.field = ?'
+            params.append(field)
+        # CROSS JOIN keeps strings as outer loop, otherwise SQLite may scan all refs for LIKE conditions
+        sql = ('SELECT f.path, s.value, r.char_idx, r.tag, r.tag_idx, r.item, r.field FROM strings s'
+            ' CROSS JOIN refs r ON r.string_id = s.id JOIN files f ON f.id = r.file_id'
+            f' WHERE {cond} ORDER BY f.path, r.char_idx, r.tag_idx, r.item')
+        if limit: sql += f' LIMIT {int(limit)}'
+        keys = ('file', 'string', 'char_idx', 'tag', 'tag_idx', 'item', 'field')
+        return [dict(zip(keys, row)) for row in self.db.execute(sql, params)]
+
+    def findFiles(self, text: str, match = MATCH_EXACT, tag: str = None, field: str = None) -> List[str]:
+        '''Sorted paths of files that have strings matching text, arguments are the same as in find()'''
+        return sorted(set(r['file'] for r in self.find(text, match, tag, field)))
+
+    def stats(self) -> Dict:
+        q = lambda sql: self.db.execute(sql).fetchone()[0]
+        return {
+            'files': q('SELECT COUNT(*) FROM files'),
+            'failed': q('SELECT COUNT(*) FROM files WHERE error IS NOT NULL'),
+            'strings': q('SELECT COUNT(*) FROM strings'),
+            'refs': q('SELECT COUNT(*) FROM refs'),
+        }
+
+def main(argv = None) -> int:
+    parser = argparse.ArgumentParser(description='Build and search index of strings in m3 files')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('update', help='index new and changed files')
+    p.add_argument('index')
+    p.add_argument('paths', nargs='+', help='m3 files or directories to scan for *.m3 and *.m3a')
+    p.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    p.add_argument('--structures', default=DEFAULT_STRUCT_FILE, help='path to structures.xml')
+    p = sub.add_parser('find', help='print files with matching strings')
+    p.add_argument('index')
+    p.add_argument('text')
+    g = p.add_mutually_exclusive_group()
+    for mode in (MATCH_SUFFIX, MATCH_PREFIX, MATCH_CONTAINS):
+        g.add_argument(f'--{mode}', dest='match', action='store_const', const=mode, help=f'{mode} match, case-insensitive')
+    p.add_argument('--tag', help='only strings referenced from this tag, e.g. LAYR')
+    p.add_argument('--field', help='only strings referenced from this field, e.g. imagePath')
+    p.add_argument('--refs', action='store_true', help='print every reference as JSON line instead of file names')
+    p = sub.add_parser('stats', help='print number of indexed files, strings and references')
+    p.add_argument('index')
+    args = parser.parse_args(argv)
+
+    with m3SearchIndex(args.index) as index:
+        if args.command == 'update':
+            print(json.dumps(index.update(args.paths, args.structures, args.jobs)))
+        elif args.command == 'find':
+            match = args.match or MATCH_EXACT
+            if args.refs:
+                for r in index.find(args.text, match, args.tag, args.field):
+                    print(json.dumps(r))
+            else:
+                for f in index.findFiles(args.text, match, args.tag, args.field):
+                    print(f)
+        else:
+            print(json.dumps(index.stats()))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''Memory accounting of opened model per tag and per subsystem
+
+    report = memoryReport(m3, shadows, glWidget)
+    print(formatReport(report))
+
+or from command line:
+
+    python m3mem.py model.m3 --top 30
+'''
+from typing import Dict, List
+from array import array
+from m3struct import m3StructFile, m3StructInfo, m3FieldInfo, m3TagToStr, DEFAULT_STRUCT_FILE
+from m3file import m3File, m3Tag
+import argparse, json, sys
+
+SUB_FILE_DATA = 'file_data'
+SUB_TAG_DATA = 'tag_data'
+SUB_TAG_OBJECTS = 'tag_objects'
+SUB_INDEX = 'index'
+SUB_REF_GRAPH = 'ref_graph'
+SUB_LAYOUTS = 'layouts'
+SUB_SHADOW_TREE = 'shadow_tree'
+SUB_GL_BUFFERS = 'gl_buffers'
+
+def objectSize(obj, seen: set = None) -> int:
+    '''Size of object with its __dict__ or __slots__ values that are not containers, objects in seen are counted once'''
+    if seen is not None:
+        if id(obj) in seen: return 0
+        seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    d = getattr(obj, '__dict__', None)
+    if d is not None:
+        size += sys.getsizeof(d)
+        values = d.values()
+    else:
+        values = [getattr(obj, s) for s in getattr(type(obj), '__slots__', ()) if hasattr(obj, s)]
+    for v in values:
+        if isinstance(v, (str, bytes, list, dict, tuple, array)):
+            if seen is not None:
+                if id(v) in seen: continue
+                seen.add(id(v))
+            size += sys.getsizeof(v)
+    return size
+
+def listSize(items: list, seen: set = None) -> int:
+    '''Size of list and its items (tuples of ints are counted as whole)'''
+    size = sys.getsizeof(items)
+    for it in items:
+        if seen is not None:
+            if id(it) in seen: continue
+            seen.add(id(it))
+        size += sys.getsizeof(it)
+    return size
+
+def fieldSize(field: m3FieldInfo, seen: set) -> int:
+    size = objectSize(field, seen)
+    for s in field.bits:
+        if not id(s) in seen:
+            seen.add(id(s))
+            size += sys.getsizeof(s)
+    return size
+
+def layoutSize(info: m3StructInfo, seen: set) -> int:
+    size = objectSize(info, seen)
+    for f in info.fields:
+        size += fieldSize(f, seen)
+    for name in ('item_fields', 'ref_fields', 'root_fields'):
+        size += listSize(getattr(info, name, []), seen)
+    for codec in (info.item_codec, info.ref_codec):
+        if codec is not None: size += objectSize(codec, seen)
+    return size
+
+def tagDataSize(tag: m3Tag) -> int:
+    '''Bytes owned by tag, data that is a view into file data or mapped file is not owned'''
+    return sys.getsizeof(tag.data) if isinstance(tag.data, bytearray) else 0
+
+def memoryReport(m3: m3File, shadows = None, glWidget = None, top = 0) -> Dict:
+    '''Attribute memory of opened model to tags and subsystems and find duplicated data buffers
+
+    shadows is uiTreeView.ShadowTree, glWidget is ui3dView.m3glWidget, both are optional.
+    If top is set, only that many largest tags are listed.
+    '''
+    subs = dict.fromkeys((SUB_FILE_DATA, SUB_TAG_DATA, SUB_TAG_OBJECTS, SUB_INDEX, SUB_REF_GRAPH, SUB_LAYOUTS, SUB_SHADOW_TREE, SUB_GL_BUFFERS), 0)
+    mapped = 0
+    if isinstance(m3.data, bytearray):
+        subs[SUB_FILE_DATA] = sys.getsizeof(m3.data)
+    else:
+        mapped = len(m3.data)
+    seen = set()
+    subs[SUB_INDEX] = listSize(m3.index, seen) + objectSize(m3.tags) + sys.getsizeof(m3.tags.items)
+    subs[SUB_LAYOUTS] = sum(layoutSize(info, seen) for info in m3.structs.layouts.values())
+
+    tags = {} # type: Dict[int, Dict]
+    def tagEntry(idx) -> Dict:
+        entry = tags.get(idx)
+        if entry is None:
+            item = m3.index[idx]
+            tag = m3.tags.items[idx]
+            entry = tags[idx] = {
+                'idx': idx,
+                'name': tag.info.name if tag else m3TagToStr(item[0]),
+                'created': tag is not None,
+                SUB_TAG_DATA: 0, SUB_TAG_OBJECTS: 0, SUB_REF_GRAPH: 0, SUB_SHADOW_TREE: 0,
+            }
+        return entry
+    for idx in range(m3.tag_count):
+        refs = m3.refFrom[idx]
+        ref_size = listSize(refs)
+        items = m3.refTo.get(idx)
+        if items:
+            ref_size += sys.getsizeof(items) + sum(listSize(r) for r in items.values())
+        subs[SUB_REF_GRAPH] += ref_size
+        tag = m3.tags.items[idx]
+        if tag is None and not refs: continue
+        entry = tagEntry(idx)
+        entry[SUB_REF_GRAPH] = ref_size
+        if tag is not None:
+            entry[SUB_TAG_DATA] = tagDataSize(tag)
+            entry[SUB_TAG_OBJECTS] = objectSize(tag)
+            cache = m3.displayCache.get(idx)
+            if cache:
+                entry[SUB_TAG_OBJECTS] += sys.getsizeof(cache) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in cache.items())
+            subs[SUB_TAG_DATA] += entry[SUB_TAG_DATA]
+            subs[SUB_TAG_OBJECTS] += entry[SUB_TAG_OBJECTS]
+
+    if shadows is not None:
+        for item in shadows.items:
+            size = objectSize(item, seen)
+            subs[SUB_SHADOW_TREE] += size
+            if item.tag is not None:
+                tagEntry(item.tag.idx)[SUB_SHADOW_TREE] += size
+        subs[SUB_SHADOW_TREE] += sys.getsizeof(shadows.items)
+
+    duplicates = [] # type: List[Dict]
+    if glWidget is not None and getattr(glWidget, 'm3', None) is m3:
+        for name, buf, tag in (('vert_mem', glWidget.vert_mem, m3.vert), ('face_mem', glWidget.face_mem, glWidget.m3faces)):
+            subs[SUB_GL_BUFFERS] += sys.getsizeof(buf)
+            if tag is not None and bytes(tag.data) == buf:
+                duplicates.append({'buffer': f'gl.{name}', 'same_as': f'{tag.info.name}#{tag.idx}', 'bytes': len(buf)})
+    if isinstance(m3.data, bytearray):
+        # created tags that were not modified still hold a copy of their bytes in file data
+        for idx, entry in tags.items():
+            tag = m3.tags.items[idx]
+            if tag is None or not isinstance(tag.data, bytearray) or idx in m3.dirty: continue
+            offset = m3.index[idx][1]
+            if m3.data[offset:offset+len(tag.data)] == tag.data:
+                duplicates.append({'buffer': f'{entry["name"]}#{idx}', 'same_as': 'file_data', 'bytes': len(tag.data)})
+
+    for entry in tags.values():
+        entry['total'] = entry[SUB_TAG_DATA] + entry[SUB_TAG_OBJECTS] + entry[SUB_REF_GRAPH] + entry[SUB_SHADOW_TREE]
+    tag_list = sorted(tags.values(), key=lambda e: e['total'], reverse=True)
+    return {
+        'file': m3.fileName,
+        'tag_count': m3.tag_count,
+        'tags_created': m3.tags.created,
+        'mapped_bytes': mapped,
+        'total': sum(subs.values()),
+        'subsystems': subs,
+        'duplicated_bytes': sum(d['bytes'] for d in duplicates),
+        'duplicates': sorted(duplicates, key=lambda d: d['bytes'], reverse=True),
+        'tags': tag_list[:top] if top else tag_list,
+    }
+
+def formatReport(report: Dict, top = 20) -> str:
+    MB = 1024 * 1024
+    lines = [f"{report['file']}: {report['total']/MB:.1f} MB in {report['tag_count']} tags ({report['tags_created']} created)"]
+    if report['mapped_bytes']:
+        lines.append(f"mapped from file (not counted): {report['mapped_bytes']/MB:.1f} MB")
+    for name, size in sorted(report['subsystems'].items(), key=lambda x: x[1], reverse=True):
+        if size: lines.append(f'  {name:<14}{size/MB:>10.2f} MB')
+    if report['duplicates']:
+        lines.append(f"duplicated buffers: {report['duplicated_bytes']/MB:.2f} MB")
+        for d in report['duplicates'][:top]:
+            lines.append(f"  {d['buffer']} = {d['same_as']}: {d['bytes']/1024:.1f} KB")
+    lines.append('largest tags:')
+    for e in report['tags'][:top]:
+        lines.append(f"  {e['name']}#{e['idx']:<8}{e['total']/1024:>10.1f} KB  (data {e[SUB_TAG_DATA]/1024:.1f}, refs {e[SUB_REF_GRAPH]/1024:.1f}, tree {e[SUB_SHADOW_TREE]/1024:.1f})")
+    return '\n'.join(lines)
+
+def main(argv = None) -> int:
+    parser = argparse.ArgumentParser(description='Print memory used by opened model')
+    parser.add_argument('file')
+    parser.add_argument('--structures', default=DEFAULT_STRUCT_FILE, help='path to structures.xml')
+    parser.add_argument('--mmap', action='store_true')
+    parser.add_argument('--all-tags', action='store_true', help='create all tags before measuring, as browsing the model would')
+    parser.add_argument('--tree', action='store_true', help='build fully expanded tags tree (requires PyQt5)')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help='print report as JSON')
+    args = parser.parse_args(argv)
+    structs = m3StructFile()
+    structs.loadFromFile(args.structures)
+    m3 = m3File(args.file, structs, args.mmap)
+    if args.all_tags:
+        for tag in m3.tags: pass
+    shadows = None
+    if args.tree:
+        from uiTreeView import ShadowTree
+        shadows = ShadowTree(m3)
+        shadows.fetchAll()
+    report = memoryReport(m3, shadows, top=args.top)
+    print(json.dumps(report, indent=2) if args.json else formatReport(report, args.top))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
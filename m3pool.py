@@ -0,0 +1,49 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''Run function over many m3 files in worker processes, structures.xml is loaded once per process
+
+    with m3pool.mapFiles(processFile, jobs, 8, DEFAULT_STRUCT_FILE) as results:
+        for res in results: ...
+
+Functions passed to mapFiles() open files with m3pool.structs.
+'''
+from typing import Callable, Iterator, List
+from contextlib import contextmanager
+from m3struct import m3StructFile
+import multiprocessing
+
+structs = None # type: m3StructFile | None
+''' structures loaded once per worker process '''
+
+def initWorker(structFileName):
+    global structs
+    structs = m3StructFile()
+    structs.loadFromFile(structFileName)
+
+@contextmanager
+def mapFiles(func: Callable, jobs: List, processes: int, structFileName) -> Iterator[Iterator]:
+    '''Yield results of func for each job, in order of completion when more than one process is used'''
+    if processes <= 1 or len(jobs) <= 1:
+        initWorker(structFileName)
+        yield map(func, jobs)
+        return
+    m3StructFile().loadFromFile(structFileName) # make sure structure cache exists before workers start reading it
+    pool = multiprocessing.Pool(processes, initWorker, (structFileName,))
+    try:
+        yield pool.imap_unordered(func, jobs, chunksize=max(1, min(16, len(jobs) // (processes * 4))))
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,135 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''Timing of model pipeline stages and counters, disabled by default
+
+    m3prof.enable()
+    with m3prof.stage(m3prof.STAGE_SAVE):
+        ...
+    m3prof.count(m3prof.CNT_BYTES_WRITTEN, size)
+    m3prof.dumpJson('profile.json')
+
+When disabled stage() returns shared no-op context and count() returns immediately.
+Stages and counters may be updated from worker threads.
+'''
+from typing import Dict, List
+from functools import wraps
+import json, threading, time
+
+STAGE_FILE_READ = 'file_read'
+STAGE_INDEX_PARSE = 'index_parse'
+STAGE_TAG_CREATE = 'tag_create'
+STAGE_STRUCTURES_LOAD = 'structures_load'
+STAGE_STRUCT_INFO = 'struct_info'
+STAGE_REF_GRAPH = 'ref_graph'
+STAGE_SHADOW_TREE = 'shadow_tree'
+STAGE_GL_UPLOAD = 'gl_upload'
+STAGE_SAVE = 'save'
+
+CNT_TAGS_CREATED = 'tags_created'
+CNT_ITEMS_SCANNED = 'items_scanned'
+CNT_BYTES_READ = 'bytes_read'
+CNT_BYTES_COPIED = 'bytes_copied'
+CNT_BYTES_WRITTEN = 'bytes_written'
+
+enabled = False
+_durations = {} # type: Dict[str, List] # name: [calls, total seconds, last seconds]
+_counters = {} # type: Dict[str, int]
+_lock = threading.Lock() # guards _durations and _counters
+
+class _NoStage():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_STAGE = _NoStage()
+
+class _Stage():
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        t = time.perf_counter() - self.start
+        with _lock:
+            d = _durations.get(self.name)
+            if d is None:
+                _durations[self.name] = [1, t, t]
+            else:
+                d[0] += 1
+                d[1] += t
+                d[2] = t
+        return False
+
+def enable(on = True):
+    global enabled
+    enabled = on
+
+def reset():
+    with _lock:
+        _durations.clear()
+        _counters.clear()
+
+def stage(name):
+    '''Context manager adding time spent inside to stage name'''
+    return _Stage(name) if enabled else _NO_STAGE
+
+def profiled(name):
+    '''Decorator version of stage()'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n = 1):
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+def snapshot() -> Dict:
+    with _lock:
+        return {
+            'stages': {name: {'calls': d[0], 'total': d[1], 'last': d[2]} for name, d in _durations.items()},
+            'counters': dict(_counters),
+        }
+
+def dumpJson(fileName):
+    with open(fileName, 'w') as file:
+        json.dump(snapshot(), file, indent=2)
+
+def summary(names: List[str] = None) -> str:
+    '''One line with last durations of stages in ms, all stages if names are not given'''
+    with _lock:
+        names = names or list(_durations)
+        return ', '.join(f'{name} {_durations[name][2]*1000:.0f} ms' for name in names if name in _durations)
+
+def details() -> str:
+    '''Multi-line text with totals of all stages and counters'''
+    with _lock:
+        lines = [f'{name}: {d[1]*1000:.1f} ms total, {d[0]} calls, last {d[2]*1000:.1f} ms' for name, d in _durations.items()]
+        lines += [f'{name}: {value}' for name, value in _counters.items()]
+    return '\n'.join(lines)
@@ -0,0 +1,260 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''In-memory inverted index of opened model for search as you type
+
+    search = m3ModelSearch(m3)
+    for tag_idx, item_idx, field_name in search.find('diffuse layr'):
+        print(search.describe((tag_idx, item_idx, field_name)))
+
+or from command line:
+
+    python m3search.py model.m3 diffuse layr
+
+Struct names, field names, CHAR strings and values of simple fields of all tags are indexed.
+Every word of query must be a prefix of some word of the result or of its struct or field name, case is ignored.
+Result is a jump target (tag index, item index or -1 for whole tag, field name or None).
+Index is built on first query and again on first query after model was changed.
+Editor builds it in background thread instead and queries the last built index while it is rebuilt.
+'''
+from typing import Callable, Dict, Iterable, List, Tuple
+from array import array
+from bisect import bisect_left
+from m3struct import m3StructFile, m3Type, DEFAULT_STRUCT_FILE
+from m3file import m3File, extractStrings
+from common import fixed8_to_float, fixed16_to_float
+import argparse, heapq, re, sys, threading, time
+
+DEFAULT_LIMIT = 100
+
+INDEX_ATTRIBUTES = ('changes', 'postings', 'namesEnd', 'words', 'targetTag', 'targetItem', 'targetField', 'fieldNames', 'fieldIds')
+''' attributes replaced when new index is built '''
+
+WORD_RE = re.compile(r'[0-9a-z]+')
+NAME_WORD_RE = re.compile(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]+')
+''' words of camelCase and UPPER_CASE names '''
+
+def textWords(text: str) -> List[str]:
+    '''Whole lower-case text and its words'''
+    low = text.lower()
+    words = WORD_RE.findall(low)
+    if low not in words: words.append(low)
+    return words
+
+def nameWords(name: str) -> List[str]:
+    words = [w.lower() for w in NAME_WORD_RE.findall(name)]
+    low = name.lower()
+    if low not in words: words.append(low)
+    return words
+
+def columnTexts(column: array, type: int) -> Iterable[str]:
+    '''Values of column as words, floats are rounded to 6 digits as they are typed'''
+    if type == m3Type.FIXED8:
+        column = map(fixed8_to_float, column)
+    elif type == m3Type.FIXED16:
+        column = map(fixed16_to_float, column)
+    elif type != m3Type.FLOAT:
+        return map(str, column)
+    return map('{:g}'.format, column)
+
+class m3ModelSearch():
+    def __init__(self, m3: m3File):
+        self.m3 = m3
+        self.changes = -1
+        ''' m3File.changes when index was built, -1 if it was not built yet '''
+        self.postings = {} # type: Dict[str, array]
+        ''' word: ascending ids of targets, names get lowest ids, then strings, then values, results are listed in that order '''
+        self.namesEnd = 0
+        ''' ids below are struct and field names '''
+        self.words = [] # type: List[str]
+        ''' sorted keys of postings for prefix search '''
+        self.targetTag = array('I')
+        self.targetItem = array('i')
+        self.targetField = array('H')
+        self.fieldNames = [None] # type: List[str | None]
+        self.fieldIds = {None: 0} # type: Dict[str | None, int]
+        self.lock = threading.Lock()
+        ''' held while built index replaces the old one '''
+        self.buildLock = threading.Lock()
+        ''' held while index is built, so that only one build runs at a time '''
+
+    def fieldId(self, field_name) -> int:
+        field_id = self.fieldIds.get(field_name)
+        if field_id is None:
+            field_id = self.fieldIds[field_name] = len(self.fieldNames)
+            self.fieldNames.append(field_name)
+        return field_id
+
+    def addTarget(self, tag_idx, item_idx, field_name, words):
+        field_id = self.fieldId(field_name)
+        tid = len(self.targetTag)
+        self.targetTag.append(tag_idx)
+        self.targetItem.append(item_idx)
+        self.targetField.append(field_id)
+        for w in words:
+            ids = self.postings.get(w)
+            if ids is None:
+                self.postings[w] = array('I', (tid,))
+            else:
+                ids.append(tid)
+
+    def isCurrent(self) -> bool:
+        '''Index was built after last change of model'''
+        return self.changes == self.m3.changes
+
+    def build(self, step: Callable[[], bool] = None) -> bool:
+        '''Build index, step() is called after each indexed column and build is stopped if it returns False
+
+        Index is built aside, find() uses the old one until new one is complete.
+        '''
+        with self.buildLock:
+            index = m3ModelSearch(self.m3)
+            self.m3.beginRead()
+            try:
+                if not index.buildIndex(step): return False
+            finally:
+                self.m3.endRead()
+            with self.lock:
+                for name in INDEX_ATTRIBUTES:
+                    setattr(self, name, getattr(index, name))
+            return True
+
+    def buildIndex(self, step: Callable[[], bool] = None) -> bool:
+        m3 = self.m3
+        changes = m3.changes
+        structs = [] # tags with fields, tags of simple types are not searched by values
+        for idx in range(1, m3.tag_count):
+            tag = m3.tags[idx]
+            info = tag.info
+            self.addTarget(idx, -1, None, nameWords(info.name))
+            if info.simple or info.type in (m3Type.CHAR, m3Type.BINARY, m3Type.VERTEX): continue
+            fields = [f for f in info.fields if f.notSelfField]
+            for f in fields:
+                self.addTarget(idx, -1, f.name, nameWords(f.name))
+            structs.append((tag, [f for f in fields if f.type in m3Type.SIMPLE]))
+        self.namesEnd = len(self.targetTag)
+        # strings and fields referencing them, as in m3index
+        for value, char_idx, tag_name, tag_idx, item_idx, field_name in extractStrings(m3):
+            words = textWords(value)
+            if tag_idx is None:
+                self.addTarget(char_idx, -1, None, words)
+            else:
+                self.addTarget(tag_idx, item_idx, field_name, words)
+        postings = self.postings
+        for tag, fields in structs:
+            for f in fields:
+                # one target per item, added in bulk as values are the most of targets
+                column = tag.getColumn(f)
+                first = len(self.targetTag)
+                self.targetTag.extend(array('I', (tag.idx,)) * len(column))
+                self.targetItem.extend(range(len(column)))
+                self.targetField.extend(array('H', (self.fieldId(f.name),)) * len(column))
+                for tid, word in enumerate(columnTexts(column, f.type), first):
+                    ids = postings.get(word)
+                    if ids is None:
+                        postings[word] = array('I', (tid,))
+                    else:
+                        ids.append(tid)
+                if step and not step():
+                    return False
+        self.words = sorted(self.postings)
+        self.changes = changes
+        return True
+
+    def matchWord(self, word: str) -> Tuple[set, set, set]:
+        '''Ids of targets with words starting with word, indices of tags and ids of fields with names matching it'''
+        ids = set()
+        tags = set()
+        fields = set()
+        i = bisect_left(self.words, word)
+        while i < len(self.words) and self.words[i].startswith(word):
+            posting = self.postings[self.words[i]]
+            ids.update(posting)
+            for tid in posting[:bisect_left(posting, self.namesEnd)]:
+                if self.targetField[tid]:
+                    fields.add(self.targetField[tid])
+                else:
+                    tags.add(self.targetTag[tid])
+            i += 1
+        return ids, tags, fields
+
+    def find(self, text: str, limit = DEFAULT_LIMIT, stale = False) -> List[Tuple[int, int, str | None]]:
+        '''Targets matching all words of text, index is built first if model was changed
+
+        With stale set, index is used as it is and nothing is found before it is built for the first time,
+        targets of items that were removed since are skipped.
+        '''
+        words = text.lower().split()
+        if not words: return []
+        if not stale and not self.isCurrent():
+            self.build()
+        with self.lock:
+            current = self.isCurrent()
+            found = self.findWords(words, limit)
+        if not current:
+            found = [t for t in found if t[1] < self.m3.tags[t[0]].count]
+        return found
+
+    def findWords(self, words: List[str], limit) -> List[Tuple[int, int, str | None]]:
+        matches = [self.matchWord(word) for word in words]
+        # result must match one word by itself, other words may match its struct or field name
+        ids = set().union(*(m[0] for m in matches))
+        for direct, tags, fields in matches:
+            if len(ids) == 0: return []
+            ids = {tid for tid in ids if tid in direct or self.targetTag[tid] in tags or self.targetField[tid] in fields}
+        ids = heapq.nsmallest(limit, ids) if limit and len(ids) > limit else sorted(ids)
+        return [(self.targetTag[i], self.targetItem[i], self.fieldNames[self.targetField[i]]) for i in ids]
+
+    def describe(self, target: Tuple[int, int, str | None]) -> str:
+        '''Text of target for list of results'''
+        tag_idx, item_idx, field_name = target
+        tag = self.m3.tags[tag_idx]
+        text = f'{tag.info.name}#{tag_idx}'
+        if item_idx >= 0:
+            text += f'[{item_idx}]'
+        if tag.info.type == m3Type.CHAR:
+            return f'{text} "{tag.getStr()}"'
+        if field_name is not None:
+            text += f'.{field_name}'
+            field = tag.info.fieldsByName.get(field_name)
+            if item_idx >= 0 and field is not None:
+                text += f' = {tag.getFieldAsStrCached(item_idx, field)}'
+        elif item_idx < 0:
+            text += f' ({tag.count})'
+        return text
+
+def main(argv = None) -> int:
+    parser = argparse.ArgumentParser(description='Search struct and field names, strings and values in model')
+    parser.add_argument('file')
+    parser.add_argument('text', nargs='+')
+    parser.add_argument('--structures', default=DEFAULT_STRUCT_FILE, help='path to structures.xml')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT)
+    args = parser.parse_args(argv)
+    structs = m3StructFile()
+    structs.loadFromFile(args.structures)
+    search = m3ModelSearch(m3File(args.file, structs))
+    t = time.perf_counter()
+    search.build()
+    build_time = time.perf_counter() - t
+    t = time.perf_counter()
+    found = search.find(' '.join(args.text), args.limit)
+    find_time = time.perf_counter() - t
+    for target in found:
+        print(search.describe(target))
+    print(f'{len(found)} results, {len(search.targetTag)} targets and {len(search.words)} words indexed in {build_time*1000:.0f} ms, query {find_time*1000:.1f} ms', file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,10 +14,24 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
-import xml.sax, re
-from struct import pack, unpack_from, calcsize
+import xml.sax, re, os, sys, pickle, hashlib, m3prof
+from struct import pack, unpack_from, calcsize, Struct
+from array import array
+from types import MappingProxyType
 from xml.sax.xmlreader import AttributesImpl
-from typing import Dict, List
+from typing import Dict, List, Tuple
+_numpy = False # not imported yet
+
+def getNumpy():
+    '''Import numpy on first use, it is optional and only needed for array views of tag data, returns None if it is missing'''
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = None
+    return _numpy
 
 def m3TagFromName(name: str) -> int:
     if name and len(name)<=4:
@@ -52,6 +66,8 @@ TAG_CHAR = m3TagFromName('CHAR')
 TAG_LAYR = m3TagFromName('LAYR')
 TAG_SEQS = m3TagFromName('SEQS')
 
+DEFAULT_STRUCT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'structures.xml')
+
 IDX_TAG = 1
 IDX_TYPE = 2
 IDX_NAME = 3
@@ -68,6 +84,20 @@ BINARY_DATA_ITEM_BYTES_COUNT = 16
 
 VERTICES_STRUCT_UNIVERSAL = 'VertexFormat'
 
+SUB_STRUCT_VERSION_RE = re.compile('(.*)V([0-9]+)$')
+
+STRUCT_CACHE_VERSION = 6
+''' increase when m3StructHandler output or m3StructInfo/m3FieldInfo attributes change '''
+STRUCT_CACHE_EXT = '.cache'
+
+LAYOUT_BINARY = 'binary'
+LAYOUT_VERTEX = 'vertex'
+
+NO_CHILDREN = ()
+''' shared child list of tree nodes without children, replaced by array on first child '''
+NO_BITS = MappingProxyType({})
+''' shared read-only bits of fields that are not flags '''
+
 class Tag:
     STRUCT = 'structure'
     DESC = 'description'
@@ -199,6 +229,32 @@ class m3Type():
         FLOAT: '<i',
     }
 
+    TYPE_TO_STRUCT = {t: Struct(f) for t, f in TYPE_TO_FORMAT.items()}
+    TYPE_TO_ARRAY = {t: f[1] for t, f in TYPE_TO_FORMAT.items()}
+    ''' array.array typecodes, fixed8 and fixed16 are kept as raw integers '''
+    TYPE_TO_HEX_STRUCT = {t: Struct(f) for t, f in TYPE_TO_HEX_FORMAT.items()}
+
+    TYPE_TO_DTYPE = {
+        UINT8: 'u1',
+        FIXED8: 'u1',
+        FIXED16: '<i2',
+        UINT16: '<u2',
+        UINT32: '<u4',
+        INT8: 'i1',
+        INT16: '<i2',
+        INT32: '<i4',
+        FLOAT: '<f4',
+        REF: ('<u4', (3,)),
+        REF_SMALL: ('<u4', (2,)),
+    }
+    ''' numpy field formats, fixed8 and fixed16 are kept as raw integers '''
+
+    TYPE_TO_ITEM_FORMAT = {
+        REF: ('III', 3),
+        REF_SMALL: ('II', 2),
+    }
+    ''' format characters and values count for item codec, simple types use TYPE_TO_FORMAT without byte order '''
+
     SIMPLE = (UINT8, UINT16, UINT32, INT8, INT16, INT32, FLOAT, FIXED8, FIXED16)
     REAL = (FLOAT, FIXED8, FIXED16)
     REFS = (REF, REF_SMALL)
@@ -242,17 +298,24 @@ class m3Type():
             return cls.TYPE_TO_SIGN_FORMAT[type]
 
 class m3FieldInfo():
+    __slots__ = ('owner', 'tree_parent', 'tree_row', 'tree_children', 'type', 'type_name', 'name', 'display_name', 'offset',
+        'default', 'expected', 'refTo', 'refToBinary', 'refToVertices', 'size', 'bitMask', 'notSelfField', 'hint', 'bits',
+        'index', 'codec', 'hex_codec')
+
     def __init__(self, owner: m3StructInfo, type_name, prefix, name, offset, Type = None, size = 0, bitMask = 0) -> None:
         self.owner = owner
+        self.index = 0
+        ''' position in owner.fields, set by m3StructInfo.addField() '''
         self.tree_parent = 0
         self.tree_row = 0
-        self.tree_children = [] # type: List[int]
+        self.tree_children = NO_CHILDREN # type: array
         if Type==None:
             self.type = m3Type.fromName(type_name)
         else:
             self.type = Type
         self.type_name = type_name
-        self.name = prefix + name # type: str
+        self.name = sys.intern(prefix + name) # type: str
+        ''' interned, same fields of other versions and vertex formats share the name '''
         self.display_name = name
         self.offset = offset
         self.default = None
@@ -264,10 +327,28 @@ class m3FieldInfo():
         self.bitMask = bitMask
         self.notSelfField = True
         self.hint = ''
-        self.bits = {} # type: Dict[str, int]
+        self.bits = NO_BITS # type: Dict[str, int]
         ''' bits[name] = mask '''
+        self.codec = m3Type.TYPE_TO_STRUCT.get(self.type) # type: Struct | None
+        ''' precompiled value format for simple types '''
+        self.hex_codec = m3Type.TYPE_TO_HEX_STRUCT.get(self.type) # type: Struct | None
+
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self.__slots__[:-2]} # codecs are last, Struct can't be pickled
+        state['bits'] = dict(self.bits) if self.bits else None # mappingproxy can't be pickled
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        if not self.bits: self.bits = NO_BITS
+        self.codec = m3Type.TYPE_TO_STRUCT.get(self.type)
+        self.hex_codec = m3Type.TYPE_TO_HEX_STRUCT.get(self.type)
 
     def noticeChild(self, child) -> int:
+        if self.tree_children is NO_CHILDREN:
+            self.tree_children = array('H', (child,))
+            return 0
         idx = len(self.tree_children)
         self.tree_children.append(child)
         return idx
@@ -314,7 +395,7 @@ class m3FieldInfo():
         return True if self.type in m3Type.REFS else False
 
     def getIndex(self) -> int:
-        return self.owner.fields.index(self)
+        return self.index
 
     def simple(self) -> bool:
         return True if self.type in m3Type.SIMPLE else False
@@ -326,6 +407,7 @@ class m3StructInfo():
         self.descr = struct[IDX_DESC] if struct and IDX_DESC in struct else ''
         self.hasRefs = False
         self.fields = [] # type: List[m3FieldInfo]
+        self.fieldsByName = {} # type: Dict[str, m3FieldInfo]
         self.root_fields = [0] # we will add at least one field
         # this can be a ref to CHAR field that hold the name of a tag item
         self.item_name_field = None # type: m3FieldInfo
@@ -333,23 +415,100 @@ class m3StructInfo():
             self.type = m3Type.CHAR
             self.simple = False
             self.item_size = 0
-            self.fields.append( m3FieldInfo(self, 'CHAR', '', 'String', 0, m3Type.CHAR) )
+            self.addField(m3FieldInfo(self, 'CHAR', '', 'String', 0, m3Type.CHAR))
         elif not struct:
             self.type = m3Type.BINARY
             self.simple = True
             self.item_size = BINARY_DATA_ITEM_BYTES_COUNT
-            self.fields.append( m3FieldInfo(self, 'Binary', '', 'bytes', 0, m3Type.BINARY, BINARY_DATA_ITEM_BYTES_COUNT) )
+            self.addField(m3FieldInfo(self, 'Binary', '', 'bytes', 0, m3Type.BINARY, BINARY_DATA_ITEM_BYTES_COUNT))
         else:
             self.type = struct[IDX_TYPE]
             self.simple = struct[IDX_SIMPLE]
             if self.simple:
                 self.item_size = m3Type.toSize(self.type)
-                self.fields.append( m3FieldInfo(self, struct[IDX_FIELDS][0][Attr.TYPE], '', 'value', 0, self.type, self.item_size) )
+                self.addField(m3FieldInfo(self, struct[IDX_FIELDS][0][Attr.TYPE], '', 'value', 0, self.type, self.item_size))
             else:
                 field = m3FieldInfo(self, self.name, '', '*** Self ***', 0, self.type)
                 field.notSelfField = False
-                self.fields.append( field )
+                self.addField(field)
                 self.item_size = self.putSubStructureFields(structFile, struct, 0, '', ver)
+        self.compileCodecs()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['item_codec'], state['ref_codec'] # Struct can't be pickled
+        state['dtype'] = None # numpy may be missing when cache is loaded
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.item_codec = Struct(self.item_format) if self.item_format else None
+        self.ref_codec = Struct(self.ref_format) if self.ref_format else None
+
+    def compileCodecs(self):
+        '''Build struct formats that decode all leaf fields or all references of an item in one call'''
+        self.compileRefCodec()
+        self.item_format = ''
+        self.dtype = None
+        self.item_codec = None # type: Struct | None
+        self.item_fields = [] # type: List[Tuple[m3FieldInfo, int, int]]
+        ''' (field, first value index, values count) for values decoded by item_codec '''
+        if self.item_size == 0: return # CHAR
+        fmt = '<'
+        pos = 0
+        count = 0
+        for f in sorted(self.fields, key=lambda x: x.offset):
+            if not f.notSelfField or f.offset < pos: continue
+            if f.type in m3Type.TYPE_TO_ITEM_FORMAT:
+                code, n = m3Type.TYPE_TO_ITEM_FORMAT[f.type]
+            elif f.type in m3Type.SIMPLE:
+                code, n = m3Type.toFormat(f.type)[1:], 1
+            elif f.type == m3Type.BINARY and f.size and not f.tree_children: # big binary fields are split into children
+                code, n = f'{f.size}s', 1
+            else:
+                continue
+            if f.offset > pos:
+                fmt += f'{f.offset - pos}x'
+            fmt += code
+            self.item_fields.append((f, count, n))
+            count += n
+            pos = f.offset + calcsize('<' + code)
+        if pos < self.item_size:
+            fmt += f'{self.item_size - pos}x'
+        if self.item_fields:
+            self.item_format = fmt
+            self.item_codec = Struct(fmt)
+
+    def compileRefCodec(self):
+        self.ref_format = ''
+        self.ref_codec = None # type: Struct | None
+        ''' decodes (count, index) pairs of all ref_fields, its size is item_size so it can be used with iter_unpack '''
+        self.ref_fields = [] # type: List[m3FieldInfo]
+        fmt = '<'
+        pos = 0
+        for f in sorted(self.fields, key=lambda x: x.offset):
+            if not (f.notSelfField and f.isRef()) or f.offset < pos: continue
+            if f.offset > pos:
+                fmt += f'{f.offset - pos}x'
+            fmt += 'II'
+            self.ref_fields.append(f)
+            pos = f.offset + calcsize('<II')
+        if self.ref_fields:
+            if pos < self.item_size:
+                fmt += f'{self.item_size - pos}x'
+            self.ref_format = fmt
+            self.ref_codec = Struct(fmt)
+
+    def getDtype(self):
+        '''Numpy structured dtype of an item made from the same fields as item_codec, requires numpy'''
+        if self.dtype is None and self.item_codec:
+            names, formats, offsets = [], [], []
+            for f, i, n in self.item_fields:
+                names.append(f.name)
+                formats.append(m3Type.TYPE_TO_DTYPE.get(f.type, ('u1', (f.size,))))
+                offsets.append(f.offset)
+            self.dtype = getNumpy().dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': self.item_size})
+        return self.dtype
 
     def putSubStructureFields(self, structFile: m3StructFile, struct, offset, prefix, ver, parent = 0, flags = 0):
         if struct:
@@ -377,8 +536,7 @@ class m3StructInfo():
                 field.size = size
                 if not self.hasRefs and field.type in (m3Type.REF, m3Type.REF_SMALL):
                     self.hasRefs = True
-                idx = len(self.fields)
-                self.fields.append(field)
+                idx = self.addField(field)
                 field.setParent(parent)
                 if Attr.ITEM_NAME in f and not self.item_name_field:
                     self.item_name_field = field
@@ -387,7 +545,7 @@ class m3StructInfo():
                     self.putSubBitsFields(field, idx, f[IDX_BITS])
 
                 if size==0: # sub structure
-                    match = re.search('(.*)V([0-9]+)$',f[Attr.TYPE])
+                    match = SUB_STRUCT_VERSION_RE.search(f[Attr.TYPE])
                     if match:
                         n = match.group(1)
                         v = int(match.group(2))
@@ -416,7 +574,7 @@ class m3StructInfo():
                     m3Type.BINARY,
                     min(BINARY_DATA_ITEM_BYTES_COUNT, parent.size - step)
                 )
-                self.fields.append(field)
+                self.addField(field)
                 field.setParent(parent_idx)
 
     def putSubBitsFields(self, parent: m3FieldInfo, parent_idx, bits: List[Dict]):
@@ -431,24 +589,28 @@ class m3StructInfo():
                 parent.size,
                 b[Attr.MASK]
             )
+            if parent.bits is NO_BITS: parent.bits = {}
             parent.bits[field.display_name] = field.bitMask
-            self.fields.append(field)
+            self.addField(field)
             field.setParent(parent_idx)
 
+    def addField(self, field: m3FieldInfo) -> int:
+        '''Append field and index it by name, first field with the name wins as in a linear search'''
+        field.index = len(self.fields)
+        self.fields.append(field)
+        self.fieldsByName.setdefault(field.name, field)
+        return field.index
+
     def getField(self, index) -> m3FieldInfo:
         if index in range(0, len(self.fields)):
             return self.fields[index]
 
     def getFieldByName(self, name) -> m3FieldInfo:
-        for f in self.fields:
-            if f.name == name:
-                return f
+        return self.fieldsByName.get(name)
 
     def getFieldOffsetByName(self, name) -> int:
-        for f in self.fields:
-            if f.name == name:
-                return f.offset
-        return 0
+        field = self.fieldsByName.get(name)
+        return field.offset if field else 0
 
     def getFieldParent(self, index) -> m3FieldInfo:
         if index in range(0, len(self.fields)):
@@ -459,11 +621,13 @@ class m3StructInfo():
     def forceBinary(self):
         self.hasRefs = False
         self.fields = [] # type: List[m3FieldInfo]
+        self.fieldsByName = {} # type: Dict[str, m3FieldInfo]
         self.root_fields = [0]
         self.type = m3Type.BINARY
         self.simple = True
         self.item_size = BINARY_DATA_ITEM_BYTES_COUNT
-        self.fields.append( m3FieldInfo(self, 'Binary', '', 'bytes', 0, m3Type.BINARY, BINARY_DATA_ITEM_BYTES_COUNT) )
+        self.addField(m3FieldInfo(self, 'Binary', '', 'bytes', 0, m3Type.BINARY, BINARY_DATA_ITEM_BYTES_COUNT))
+        self.compileCodecs()
 
     def forceVertices(self, structFile: m3StructFile, vflags: int):
         struct = structFile.ByName(VERTICES_STRUCT_UNIVERSAL)
@@ -471,13 +635,15 @@ class m3StructInfo():
         self.name = f'VERTEX ({self.name})'
         self.hasRefs = False
         self.fields = [] # type: List[m3FieldInfo]
+        self.fieldsByName = {} # type: Dict[str, m3FieldInfo]
         self.root_fields = [0]
         self.type = m3Type.VERTEX
         self.simple = False
         field = m3FieldInfo(self, 'Vertex', '', '*** Self ***', 0, self.type)
         field.notSelfField = False
-        self.fields.append( field )
+        self.addField(field)
         self.item_size = self.putSubStructureFields(structFile, struct, 0, '', 0, flags=vflags)
+        self.compileCodecs()
 
     def notifyParent(self, parent, child: int):
         if parent in range(1, len(self.fields)):
@@ -493,7 +659,43 @@ class m3StructFile():
     def __init__(self):
         self.structByName = {}
         self.structByTag = {}
-    
+        self.layouts = {} # type: Dict[Tuple, m3StructInfo]
+        ''' shared m3StructInfo objects, see getStructInfo() '''
+        self.cacheFileName = ''
+        self.xmlHash = ''
+
+    def getStructInfo(self, tag: int, ver: int) -> m3StructInfo:
+        '''Return m3StructInfo shared by all tags with same tag and version, it must not be modified'''
+        key = (tag, ver)
+        info = self.layouts.get(key)
+        if info is None:
+            with m3prof.stage(m3prof.STAGE_STRUCT_INFO):
+                info = m3StructInfo(tag, ver, self)
+            self.layouts[key] = info
+        return info
+
+    def getBinaryStructInfo(self, tag: int, ver: int) -> m3StructInfo:
+        '''Shared m3StructInfo for tag data that is forced to be displayed as binary'''
+        key = (tag, ver, LAYOUT_BINARY)
+        info = self.layouts.get(key)
+        if info is None:
+            with m3prof.stage(m3prof.STAGE_STRUCT_INFO):
+                info = m3StructInfo(tag, ver, self)
+                info.forceBinary()
+            self.layouts[key] = info
+        return info
+
+    def getVertexStructInfo(self, tag: int, ver: int, vflags: int) -> m3StructInfo:
+        '''Shared m3StructInfo for vertices tag data with vertex format defined by vflags'''
+        key = (tag, ver, LAYOUT_VERTEX, vflags)
+        info = self.layouts.get(key)
+        if info is None:
+            with m3prof.stage(m3prof.STAGE_STRUCT_INFO):
+                info = m3StructInfo(tag, ver, self)
+                info.forceVertices(self, vflags)
+            self.layouts[key] = info
+        return info
+
     def ByTag(self, tag: int):
         if tag in self.structByTag:
             return self.structByTag[tag]
@@ -502,7 +704,18 @@ class m3StructFile():
         if name in self.structByName:
             return self.structByName[name]
 
-    def loadFromFile(self, fileName):
+    @m3prof.profiled(m3prof.STAGE_STRUCTURES_LOAD)
+    def loadFromFile(self, fileName, useCache = True):
+        '''Load structures from xml file, parsed result is cached in "<fileName>.cache" file if useCache is set'''
+        self.layouts.clear()
+        if useCache:
+            self.cacheFileName = fileName + STRUCT_CACHE_EXT
+            with open(fileName, 'rb') as file:
+                self.xmlHash = hashlib.sha1(file.read()).hexdigest()
+                file.close()
+            if self.loadCache(): return
+        self.structByName = {}
+        self.structByTag = {}
         parser = xml.sax.make_parser()
         # turn off namepsaces
         parser.setFeature(xml.sax.handler.feature_namespaces, 0)
@@ -512,6 +725,42 @@ class m3StructFile():
         parser.setContentHandler( Handler )
 
         parser.parse(fileName)
+        if useCache:
+            self.saveCache()
+
+    def loadCache(self) -> bool:
+        '''Load parsed structures from cache file, returns False if cache is missing or stale'''
+        try:
+            with open(self.cacheFileName, 'rb') as file:
+                cache = pickle.load(file)
+                file.close()
+            if cache['version'] != STRUCT_CACHE_VERSION or cache['hash'] != self.xmlHash:
+                return False
+            self.structByName = cache['byName']
+            self.structByTag = cache['byTag']
+            self.layouts = cache['layouts']
+            return True
+        except Exception: # any unreadable cache is rebuilt from xml
+            return False
+
+    def saveCache(self, withLayouts = False):
+        '''Save parsed structures to cache file, layouts built so far are saved too if withLayouts is set'''
+        if not self.cacheFileName: return
+        cache = {
+            'version': STRUCT_CACHE_VERSION,
+            'hash': self.xmlHash,
+            'byName': self.structByName,
+            'byTag': self.structByTag,
+            'layouts': self.layouts if withLayouts else {},
+        }
+        temp = f'{self.cacheFileName}.{os.getpid()}.tmp'
+        try:
+            with open(temp, 'wb') as file:
+                pickle.dump(cache, file, pickle.HIGHEST_PROTOCOL)
+                file.close()
+            os.replace(temp, self.cacheFileName)
+        except OSError: # cache is optional, read-only location is not an error
+            if os.path.exists(temp): os.remove(temp)
 
 class m3StructHandler( xml.sax.ContentHandler ):
     def __init__(self, file: m3StructFile):
@@ -652,7 +901,7 @@ if __name__ == '__main__':
                 struct[key]['r'] = f[Attr.REF_TO]
             size = m3Type.toSize(m3Type.fromName(f[Attr.TYPE]))
             if not Attr.SIZE in f and size==0:
-                match = re.search('(.*)V([0-9]+)$',f[Attr.TYPE])
+                match = SUB_STRUCT_VERSION_RE.search(f[Attr.TYPE])
                 if match:
                     n = match.group(1)
                 else:
@@ -0,0 +1,100 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''Field lookup of m3StructInfo and cached display texts of edited tags
+
+    python -m unittest discover tests
+'''
+import os, shutil, sys, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from m3struct import m3StructFile, m3TagFromName, DEFAULT_STRUCT_FILE
+from m3file import m3File, m3Tag
+from m3gen import writeModel
+
+class FieldsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp(prefix='m3test')
+        xmlFile = os.path.join(cls.workDir, 'structures.xml')
+        shutil.copy(DEFAULT_STRUCT_FILE, xmlFile)
+        cls.structs = m3StructFile()
+        cls.structs.loadFromFile(xmlFile)
+        cls.model = os.path.join(cls.workDir, 'model.m3')
+        writeModel(cls.model, cls.structs, bones=20, vertices=100, sequences=2, animated_bones=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def setUp(self):
+        self.m3 = m3File(self.model, self.structs)
+        self.bone = self.m3.tags[self.m3.tagIndices(m3TagFromName('BONE'))[0]]
+
+    def assertCachedText(self, tag: m3Tag, item_idx, field):
+        self.assertEqual(tag.getFieldAsStrCached(item_idx, field), tag.getFieldAsStr(item_idx, field))
+
+    def testLookup(self):
+        for tag in self.m3.tags: # includes vertex layout made from vflags
+            info = tag.info
+            for i, f in enumerate(info.fields):
+                self.assertIs(info.getField(f.index), f)
+                self.assertEqual(f.index, i)
+                # first field with the name, as linear search found it
+                self.assertIs(info.getFieldByName(f.name), next(x for x in info.fields if x.name == f.name))
+        self.assertIsNone(self.bone.info.getFieldByName('no such field'))
+
+    def testCachedTextAfterSetItem(self):
+        flags = self.bone.info.getFieldByName('flags')
+        name = self.bone.info.getFieldByName('name')
+        self.bone.getFieldAsStrCached(0, flags)
+        self.bone.setItem(0, {'flags': 5})
+        self.assertCachedText(self.bone, 0, flags)
+
+        old = self.bone.getItemNameCached(0)
+        other = self.bone.getReff(1, name).idx
+        self.bone.setItem(0, {'name': self.bone.getItem(1)['name']}) # reference to name of other bone
+        self.assertNotEqual(self.bone.getItemNameCached(0), old)
+        self.assertEqual(self.bone.getItemNameCached(0), self.bone.getItemName(0))
+
+        self.bone.getItemNameCached(1)
+        renamed = 'x' * len(self.m3.tags[other].getStr()) # same length, references to it are not rewritten
+        self.m3.tags[other].setStr(renamed) # text of bones that show its name is dropped through refFrom
+        self.assertEqual(self.bone.getItemNameCached(0), self.bone.getItemName(0))
+        self.assertIn(renamed, self.bone.getItemNameCached(1))
+
+    def testColumn(self):
+        flags = self.bone.info.getFieldByName('flags')
+        values = [i * 3 for i in range(self.bone.count)]
+        self.bone.setColumn('flags', values)
+        self.assertEqual(list(self.bone.getColumn(flags)), values)
+        self.assertEqual([self.bone.getItem(i)['flags'] for i in range(self.bone.count)], values)
+        self.bone.setColumn(flags, [7, 8], start=2)
+        self.assertEqual(list(self.bone.getColumn(flags, 1, 5)), [3, 7, 8, 12])
+
+        vert = self.m3.vert # fields of vertex layout are named with dots
+        column = vert.getColumn('uv0.x')
+        vert.setColumn('uv0.x', column[::-1])
+        self.assertEqual(list(vert.getColumn('uv0.x')), list(column[::-1]))
+
+    def testCachedTextAfterSetColumn(self):
+        flags = self.bone.info.getFieldByName('flags')
+        for i in range(self.bone.count):
+            self.bone.getFieldAsStrCached(i, flags)
+        self.bone.setColumn(flags, range(100, 100 + self.bone.count))
+        for i in range(self.bone.count):
+            self.assertCachedText(self.bone, i, flags)
+
+if __name__ == '__main__':
+    unittest.main()
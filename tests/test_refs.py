@@ -0,0 +1,85 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''Incremental update of m3File.refFrom and orphans by reference edits
+
+    python -m unittest discover tests
+'''
+import os, random, shutil, sys, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from m3struct import m3StructFile, m3TagFromName, DEFAULT_STRUCT_FILE
+from m3file import m3File, REF_FROM_TAG, REF_FROM_ITEM, REF_FROM_FIELD
+from m3gen import writeModel
+
+class RefFromTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp(prefix='m3test')
+        xmlFile = os.path.join(cls.workDir, 'structures.xml')
+        shutil.copy(DEFAULT_STRUCT_FILE, xmlFile)
+        cls.structs = m3StructFile()
+        cls.structs.loadFromFile(xmlFile)
+        cls.model = os.path.join(cls.workDir, 'model.m3')
+        writeModel(cls.model, cls.structs, bones=20, vertices=100, sequences=2, animated_bones=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def snapshot(self, m3: m3File):
+        '''refFrom and orphans, refFrom lists are sorted because incremental updates append to them'''
+        return [sorted(refs) for refs in m3.refFrom], list(m3.orphans)
+
+    def testUnreferencedTagBecomesOrphan(self):
+        m3 = m3File(self.model, self.structs)
+        bone = m3.tags[m3.tagIndices(m3TagFromName('BONE'))[0]]
+        name = bone.info.getFieldByName('name')
+        char = bone.getReff(0, name).idx
+        self.assertNotIn(char, m3.orphans)
+        bone.setRef(0, name, 0)
+        self.assertEqual(m3.refFrom[char], [])
+        self.assertIn(char, m3.orphans)
+        bone.setRef(1, name, char) # two references to the same tag
+        bone.setRef(0, name, char)
+        self.assertNotIn(char, m3.orphans)
+        bone.setRef(1, name, 0)
+        self.assertNotIn(char, m3.orphans)
+        self.assertEqual([(r[REF_FROM_TAG], r[REF_FROM_ITEM], r[REF_FROM_FIELD]) for r in m3.refFrom[char]], [(bone.idx, 0, 'name')])
+
+    def checkRandomEdits(self, findRefsFirst):
+        m3 = m3File(self.model, self.structs)
+        if findRefsFirst: m3.refFrom
+        rnd = random.Random(8)
+        fields = [(tag, f) for tag in m3.tags if tag.idx and tag.count for f in tag.info.ref_fields]
+        for n in range(500):
+            tag, f = rnd.choice(fields)
+            item = rnd.randrange(tag.count)
+            ref_idx = rnd.choice([0, rnd.randrange(1, m3.tag_count)])
+            if n % 2:
+                tag.setRef(item, f, ref_idx)
+            else:
+                tag.setItem(item, {f.name: (1 if ref_idx else 0, ref_idx) + tag.getItem(item)[f.name][2:]})
+        updated = self.snapshot(m3)
+        m3.rebildRefFrom()
+        self.assertEqual(updated, self.snapshot(m3))
+
+    def testRandomEdits(self):
+        self.checkRandomEdits(True)
+
+    def testRandomEditsBeforeRefsFound(self):
+        self.checkRandomEdits(False)
+
+if __name__ == '__main__':
+    unittest.main()
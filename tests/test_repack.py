@@ -0,0 +1,65 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''m3File.repackIntoData() of copied and memory-mapped models
+
+    python -m unittest discover tests
+'''
+import os, shutil, sys, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from m3struct import m3StructFile, TAG_CHAR, DEFAULT_STRUCT_FILE
+from m3file import m3File
+from m3gen import writeModel
+
+NEW_NAME = 'name that is longer than any generated one'
+
+class RepackTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp(prefix='m3test')
+        xmlFile = os.path.join(cls.workDir, 'structures.xml')
+        shutil.copy(DEFAULT_STRUCT_FILE, xmlFile)
+        cls.structs = m3StructFile()
+        cls.structs.loadFromFile(xmlFile)
+        cls.model = os.path.join(cls.workDir, 'model.m3')
+        writeModel(cls.model, cls.structs, bones=20, vertices=100, sequences=2, animated_bones=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def checkRepack(self, useMmap):
+        m3 = m3File(self.model, self.structs, useMmap)
+        char = m3.tagIndices(TAG_CHAR)[0]
+        m3.tags[char].setStr(NEW_NAME) # resizes tag, offsets of following tags change
+        m3.repackIntoData()
+        self.assertIsNone(m3.mmap)
+        expected = m3File(self.model, self.structs)
+        expected.tags[char].setStr(NEW_NAME)
+        for idx in range(1, m3.tag_count): # tags created after repack are read from repacked data
+            self.assertEqual(bytes(m3.tags[idx].data), bytes(expected.tags[idx].data), f'tag #{idx}')
+        out = os.path.join(self.workDir, 'out.m3')
+        m3.saveToFile(out)
+        saved = m3File(out, self.structs)
+        self.assertEqual(saved.tags[char].getStr(), NEW_NAME)
+
+    def testRepack(self):
+        self.checkRepack(False)
+
+    def testRepackMapped(self):
+        self.checkRepack(True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# This file is a part of "M3 Editor, python variant" project <https://github.com/tangorcraft/m3editor-python/>.
+# Copyright (C) 2023  Ivan Markov (TangorCraft)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''m3File.save(): atomic saveToFile() by default, patchFile() in place only when asked and allowed
+
+    python -m unittest discover tests
+'''
+import os, shutil, sys, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from m3struct import m3StructFile, m3TagFromName, TAG_CHAR, DEFAULT_STRUCT_FILE
+from m3file import m3File
+from m3gen import writeModel
+
+class SaveTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp(prefix='m3test')
+        xmlFile = os.path.join(cls.workDir, 'structures.xml')
+        shutil.copy(DEFAULT_STRUCT_FILE, xmlFile)
+        cls.structs = m3StructFile()
+        cls.structs.loadFromFile(xmlFile)
+        cls.original = os.path.join(cls.workDir, 'original.m3')
+        writeModel(cls.original, cls.structs, bones=20, vertices=1000, sequences=2, animated_bones=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir, ignore_errors=True)
+
+    def setUp(self):
+        self.model = os.path.join(self.workDir, 'model.m3')
+        shutil.copy(self.original, self.model)
+
+    def editBone(self, m3: m3File, value):
+        bone = m3.tags[m3.tagIndices(m3TagFromName('BONE'))[0]]
+        bone.setItem(0, {'flags': value})
+
+    def expectedBytes(self, edit) -> bytes:
+        '''File bytes after edit(m3) saved with saveToFile() into other file'''
+        m3 = m3File(self.original, self.structs)
+        edit(m3)
+        out = os.path.join(self.workDir, 'expected.m3')
+        m3.saveToFile(out)
+        with open(out, 'rb') as f:
+            return f.read()
+
+    def readModel(self) -> bytes:
+        with open(self.model, 'rb') as f:
+            return f.read()
+
+    def testSaveIsAtomicByDefault(self):
+        m3 = m3File(self.model, self.structs)
+        ino = os.stat(self.model).st_ino
+        self.editBone(m3, 5)
+        self.assertFalse(m3.save(self.model))
+        self.assertNotEqual(os.stat(self.model).st_ino, ino) # replaced with new file
+        self.assertEqual(self.readModel(), self.expectedBytes(lambda m: self.editBone(m, 5)))
+        self.assertFalse(m3.dirty)
+
+    def testPatch(self):
+        m3 = m3File(self.model, self.structs)
+        ino = os.stat(self.model).st_ino
+        self.editBone(m3, 5)
+        self.assertTrue(m3.save(self.model, patch=True))
+        self.assertEqual(os.stat(self.model).st_ino, ino) # written in place
+        self.assertEqual(self.readModel(), self.expectedBytes(lambda m: self.editBone(m, 5)))
+        self.editBone(m3, 6) # layout saved by patch can be patched again
+        self.assertTrue(m3.save(self.model, patch=True))
+        self.assertEqual(self.readModel(), self.expectedBytes(lambda m: self.editBone(m, 6)))
+
+    def testPatchRefused(self):
+        def resize(m3: m3File):
+            m3.tags[m3.tagIndices(TAG_CHAR)[0]].setStr('name that is longer than any generated one')
+        m3 = m3File(self.model, self.structs)
+        resize(m3)
+        self.assertFalse(m3.canPatchFile(self.model)) # tag size changed
+        self.assertFalse(m3.save(self.model, patch=True))
+        self.assertEqual(self.readModel(), self.expectedBytes(resize))
+
+        m3 = m3File(self.model, self.structs)
+        self.editBone(m3, 5)
+        other = os.path.join(self.workDir, 'other.m3')
+        shutil.copy(self.model, other)
+        self.assertFalse(m3.canPatchFile(other)) # not the file it was loaded from
+        st = os.stat(self.model)
+        os.utime(self.model, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertFalse(m3.canPatchFile(self.model)) # changed since it was loaded
+
+        m3 = m3File(self.model, self.structs)
+        m3.tags[m3.vert.idx].getWritableData() # vertices are most of the file
+        self.assertFalse(m3.canPatchFile(self.model))
+
+if __name__ == '__main__':
+    unittest.main()
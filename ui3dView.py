@@ -24,7 +24,7 @@ from m3file import m3File, m3Tag
 from m3struct import m3FieldInfo
 from gl.glMath import glmMatrix44
 from gl.glmHorCam import glmHorizontalCamera
-import m3
+import m3, m3prof
 
 def vec3_data(v1, v2, v3):
     return pack('<fff', v1, v2, v3)
@@ -410,8 +410,10 @@ class m3glWidget(QtWidgets.QOpenGLWidget):
         self.vert_stride = self.m3.vert.info.item_size
         self.vert_mem = bytes(self.m3.vert.data)
         self.face_mem = bytes(self.m3faces.data)
+        m3prof.count(m3prof.CNT_BYTES_COPIED, len(self.vert_mem) + len(self.face_mem))
         if self.gl_init_done: self.updateM3Data()
 
+    @m3prof.profiled(m3prof.STAGE_GL_UPLOAD)
     def updateM3Data(self):
         self.makeCurrent()
         gl.glBindVertexArray(self.vao)
@@ -13,12 +13,16 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import List, Callable
+from typing import Dict, List, Tuple
+from array import array
 from PyQt5.QtCore import *
-from m3file import m3File, m3Tag
-from m3struct import m3StructFile, m3Type, m3FieldInfo, BINARY_DATA_ITEM_BYTES_COUNT
+from m3file import m3File, m3Tag, REF_FROM_TAG, REF_FROM_ITEM, REF_FROM_FIELD, REF_FROM_OFFSET
+from m3search import m3ModelSearch
+from m3struct import m3StructFile, m3Type, m3FieldInfo, BINARY_DATA_ITEM_BYTES_COUNT, NO_CHILDREN
 from editors.fieldHandlers import fieldHandlersCollection
 from common import ceildiv, clampi
+import m3prof, time
+from collections import deque
 
 SHADOW_TAG, SHADOW_IT, SHADOW_GRP, SHADOW_DUP = range(4)
 SHADOW_GRP_COUNT = 20
@@ -26,47 +30,68 @@ SHADOW_GRP_COUNT = 20
 DEFAULT_SIMPLE_FIELDS_DISPLAY_COUNT = 50
 
 class ShadowItem():
-    def __init__(self, notifyParent: Callable[[int, int], int], index: int, type: int, parent: int, text: str, tag: m3Tag = None, tag_item = -1):
-        #self.owner = owner
+    __slots__ = ('index', 'parent', 'row', 'children', 'fetched', 'type', 'text', 'tag', 'tag_item')
+
+    def __init__(self, index: int, type: int, parent: int, row: int, text: str, tag: m3Tag = None, tag_item = -1, fetched = False):
         self.index = index
         self.parent = parent
-        if parent==None:
-            self.row = 0
-        else:
-            self.row = notifyParent(parent, index)
-        self.children = [] # type: List[int]
+        self.row = row
+        self.children = NO_CHILDREN # type: array
+        self.fetched = fetched
+        ''' children are created by ShadowTree.newChildren() when item is expanded, items that can't have children are created fetched '''
 
         self.type = type
         self.text = text
+        ''' None for SHADOW_IT, its text is made by ShadowTree.getText() when item is shown '''
         self.tag = tag
         self.tag_item = tag_item
-    
-    def noticeChild(self, child):
-        ret = len(self.children)
-        self.children.append(child)
-        return ret
+        ''' item index for SHADOW_IT, first item index for SHADOW_GRP '''
 
 class ShadowTree():
+    '''Shadow items of tags tree, only top level is created on load and children are created when parent is expanded'''
     def __init__(self, m3: m3File = None):
         self.processM3(m3)
 
+    @m3prof.profiled(m3prof.STAGE_SHADOW_TREE)
     def processM3(self, m3: m3File):
         self.m3 = m3
         if m3:
-            self.root = ShadowItem(self.notifyParent, 0, SHADOW_TAG, None, 'model', m3.modl)
+            self.root = ShadowItem(0, SHADOW_TAG, None, 0, 'model', m3.modl, fetched=not m3.modl.count)
         else:
-            self.root = ShadowItem(self.notifyParent, 0, SHADOW_GRP, None, 'no model opened')
-        self.orphan_root = ShadowItem(self.notifyParent, 1, SHADOW_GRP, None, 'orphan tags (not referenced from others)')
-        self.orphan_root.row = 1
+            self.root = ShadowItem(0, SHADOW_GRP, None, 0, 'no model opened', fetched=True)
+        self.orphan_root = ShadowItem(1, SHADOW_GRP, None, 1, 'orphan tags (not referenced from others)', fetched=not (m3 and m3.orphans))
         self.items = [self.root, self.orphan_root] # type: List[ShadowItem]
-        self.tags = [] # type: List[m3Tag]
-        self.lastTagIdx = 0
-        self.processTag(0, None)
-        if m3:
-            for orph in self.m3.orphans:
-                tag = self.m3.tags[orph]
-                if not tag in self.tags:
-                    self.processTag(1, tag)
+        self.owners = None # type: Dict[int, Tuple[int, int, str] | None] | None
+        ''' tag index: (tag index, item index, field name) of reference that shows items of tag, None for top level tags, see getOwners() '''
+
+    def getOwners(self) -> Dict[int, Tuple[int, int, str] | None]:
+        '''Owning reference of every tag reachable from model and orphan tags, first one found breadth-first
+
+        Owners are found once, so a tag keeps its place in tree when references are edited,
+        and every owner is an item of an owned tag, so items of every reachable tag can be expanded.
+        '''
+        if self.owners is None:
+            m3 = self.m3
+            owners = {m3.modl.idx: None} # type: Dict[int, Tuple[int, int, str] | None]
+            for orph in m3.orphans:
+                owners[orph] = None
+            # references from each tag, taken from refFrom so that m3File.refTo is only read for tags shown
+            refsFrom = {} # type: Dict[int, List[Tuple[int, int, str, int]]]
+            for ref_idx, refs in enumerate(m3.refFrom):
+                for ref in refs:
+                    refsFrom.setdefault(ref[REF_FROM_TAG], []).append((ref[REF_FROM_OFFSET], ref[REF_FROM_ITEM], ref[REF_FROM_FIELD], ref_idx))
+            queue = deque(owners)
+            while queue:
+                idx = queue.popleft()
+                refs = refsFrom.get(idx)
+                if not refs: continue
+                refs.sort() # data offset orders references by item and then by field
+                for offset, item_idx, field_name, ref_idx in refs:
+                    if ref_idx not in owners:
+                        owners[ref_idx] = (idx, item_idx, field_name)
+                        queue.append(ref_idx)
+            self.owners = owners
+        return self.owners
 
     def getShadowIndex(self, parent, row):
         if parent in range(0, len(self.items)):
@@ -77,19 +102,24 @@ class ShadowTree():
         if index in range(0, len(self.items)):
             return self.items[index]
 
-    def notifyParent(self, parent, child) -> int:
-        if parent in range(0, len(self.items)):
-            return self.items[parent].noticeChild(child)
-
-    def isTagDuplicate(self, tag: m3Tag):
-        if tag in self.tags:
-            return True
-        else:
-            self.tags.append(tag)
-            return False
+    def hasOrphans(self) -> bool:
+        return True if self.m3 and self.m3.orphans else False
+
+    def mayHaveChildren(self, shadow: ShadowItem) -> bool:
+        '''Check if item has children without creating them'''
+        if shadow.fetched:
+            return len(shadow.children) > 0
+        if shadow.type == SHADOW_IT:
+            return len(shadow.tag.getRefsTo(shadow.tag_item)) > 0
+        return True
+
+    def isAncestorTag(self, shadow: ShadowItem, tag: m3Tag) -> bool:
+        while shadow is not None:
+            if shadow.tag is tag: return True
+            shadow = self.items[shadow.parent] if shadow.parent is not None else None
+        return False
 
-    def newTagShadow(self, parent, tag: m3Tag, parent_field: m3FieldInfo = None):
-        idx = len(self.items)
+    def newTagShadow(self, parent: ShadowItem, row, tag: m3Tag, parent_field: m3FieldInfo = None) -> ShadowItem:
         prefix = f'{parent_field.name}->' if parent_field else ''
         if not tag:
             text = f'ERROR: Invalid m3Tag ({tag})'
@@ -97,86 +127,253 @@ class ShadowTree():
             text = f'{tag.info.name}#{tag.idx} {tag.getItemName()}'
         else:
             text = f'{tag.info.name}#{tag.idx} ({tag.count})'
-        self.items.append( ShadowItem(
-            self.notifyParent,
-            idx,
-            SHADOW_DUP if self.isTagDuplicate(tag) else SHADOW_TAG,
-            parent,
+        duplicate = False
+        leaf = not tag or tag.info.isSingleField() or tag.info.type == m3Type.VERTEX or tag.count == 0
+        if tag and parent.type == SHADOW_IT:
+            # tag referenced from several places shows its items only under its owning reference,
+            # tags referenced only after owners were found are owned by the first reference shown
+            ref = (parent.tag.idx, parent.tag_item, parent_field.name)
+            duplicate = self.getOwners().setdefault(tag.idx, ref) != ref
+            leaf = leaf or duplicate or self.isAncestorTag(parent, tag) # reference loop
+        return ShadowItem(
+            len(self.items),
+            SHADOW_DUP if duplicate else SHADOW_TAG,
+            parent.index,
+            row,
             prefix + text,
-            tag
-        ) )
-        return idx
-
-    def newItemShadow(self, parent, tag: m3Tag, item_idx: int):
-        idx = len(self.items)
-        self.items.append( ShadowItem(
-            self.notifyParent,
-            idx,
+            tag,
+            fetched=leaf
+        )
+
+    def newItemShadow(self, parent: ShadowItem, row, tag: m3Tag, item_idx: int) -> ShadowItem:
+        return ShadowItem(
+            len(self.items),
             SHADOW_IT,
-            parent,
-            f'{tag.info.name}[{item_idx}]{tag.getItemName(item_idx)}',
+            parent.index,
+            row,
+            None,
             tag,
             item_idx
-        ) )
-        return idx
+        )
+
+    def getText(self, shadow: ShadowItem) -> str:
+        '''Item names are resolved only for shown items, they are cached by m3File until referenced names change'''
+        if shadow.type == SHADOW_IT:
+            return f'{shadow.tag.info.name}[{shadow.tag_item}]{shadow.tag.getItemNameCached(shadow.tag_item)}'
+        return shadow.text
 
-    def newGrpShadow(self, parent, start, max_count):
-        idx = len(self.items)
+    def newGrpShadow(self, parent: ShadowItem, row, start, max_count) -> ShadowItem:
         end = min(start + SHADOW_GRP_COUNT - 1, max_count - 1)
-        if start==end: # do not create group for 1 item
-            return parent
-        self.items.append( ShadowItem(
-            self.notifyParent,
-            idx,
+        return ShadowItem(
+            len(self.items),
             SHADOW_GRP,
-            parent,
-            f'[{start:02d}-{end:02d}]'
-        ) )
-        return idx
-
-    def processItem(self, tree_item, tag: m3Tag, item_idx):
-        for f in tag.info.fields:
-            if f.notSelfField and f.type in m3Type.REFS and tag.refIsValid(item_idx, f):
-                self.processTag(tree_item, tag.getReff(item_idx, f), f)
-
-    def processGroup(self, parent, tag: m3Tag, start):
-        count = min(start + SHADOW_GRP_COUNT, tag.count)
-        for it in range(start,count):
-            self.processItem(
-                self.newItemShadow(parent, tag, it),
-                tag,
-                it
-            )
-
-    def processTag(self, parent, tag: m3Tag, parent_field: m3FieldInfo = None):
-        if not tag: # processing root
-            shadow = 0
-            tag = self.root.tag
-        else:
-            shadow = self.newTagShadow(parent, tag, parent_field)
-        # do not display children of simple tags in the tree
-        # also don't process thags with index less than last to prevent possible ref loops
-        # and don't put vertices as children in the tree
-        if not tag or tag.info.isSingleField() or tag.idx < self.lastTagIdx or tag.info.type == m3Type.VERTEX: return
-        self.lastTagIdx = tag.idx
-        if tag.count > SHADOW_GRP_COUNT:
-            for start in range(0,tag.count,SHADOW_GRP_COUNT):
-                grp = self.newGrpShadow(shadow, start, tag.count)
-                self.processGroup(grp,tag,start)
+            parent.index,
+            row,
+            f'[{start:02d}-{end:02d}]',
+            tag_item=start
+        )
+
+    def newChildren(self, shadow: ShadowItem) -> List[ShadowItem]:
+        '''Create children of not yet fetched item, they are added to tree by setChildren()'''
+        children = [] # type: List[ShadowItem]
+        if shadow.fetched: return children
+        def add(item: ShadowItem):
+            children.append(item)
+            self.items.append(item)
+        if shadow is self.orphan_root:
+            for orph in self.m3.orphans:
+                add(self.newTagShadow(shadow, len(children), self.m3.tags[orph]))
+        elif shadow.type == SHADOW_IT:
+            # references are taken from adjacency kept by m3File instead of reading every reference field
+            tags = self.m3.tags
+            for f, ref_idx in shadow.tag.getRefsTo(shadow.tag_item):
+                add(self.newTagShadow(shadow, len(children), tags[ref_idx], f))
+        elif shadow.type == SHADOW_GRP:
+            tag = self.items[shadow.parent].tag
+            for it in range(shadow.tag_item, min(shadow.tag_item + SHADOW_GRP_COUNT, tag.count)):
+                add(self.newItemShadow(shadow, len(children), tag, it))
+        elif shadow.tag.count > SHADOW_GRP_COUNT:
+            tag = shadow.tag
+            for start in range(0, tag.count, SHADOW_GRP_COUNT):
+                if start == tag.count - 1: # do not create group for 1 item
+                    add(self.newItemShadow(shadow, len(children), tag, start))
+                else:
+                    add(self.newGrpShadow(shadow, len(children), start, tag.count))
         else:
-            self.processGroup(shadow,tag,0)
+            for it in range(shadow.tag.count):
+                add(self.newItemShadow(shadow, len(children), shadow.tag, it))
+        return children
+
+    def setChildren(self, shadow: ShadowItem, children: List[ShadowItem]):
+        if children:
+            shadow.children = array('I', (c.index for c in children))
+        shadow.fetched = True
+
+    def fetchAll(self):
+        '''Create whole tree, as it was before children were created on expand'''
+        i = 0
+        while i < len(self.items):
+            shadow = self.items[i]
+            self.setChildren(shadow, self.newChildren(shadow))
+            i += 1
+
+class ShadowTreeBuilder(QThread):
+    '''Creates whole tree in worker thread with its own ShadowTree, created children are sent to GUI thread in batches
+
+    batchReady(builder, batch, done) batch is list of (parent index, first child index, [(type, text, tag, tag_item, fetched)])
+    where indices are in builder's tree.
+    Model is registered as read by m3File.beginRead() from creation until run() ends, so that it is not changed during build,
+    builder must be started right after it is created.
+    '''
+    batchReady = pyqtSignal(object, object, bool)
+    BATCH_SECONDS = 0.05
+    WORK_SECONDS = 0.01
+    PAUSE_SECONDS = 0.004
+    ''' worker pauses after each WORK_SECONDS, so that GUI thread gets the GIL without waiting for switch interval '''
+
+    def __init__(self, m3: m3File):
+        super().__init__(None)
+        self.tree = ShadowTree(m3)
+        self.cancelled = False
+        m3.beginRead()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            batch = self.buildTree()
+        finally:
+            self.tree.m3.endRead()
+        if not self.cancelled: # model can be edited when the last batch arrives
+            self.batchReady.emit(self, batch, True)
+
+    def buildTree(self) -> List:
+        '''Create tree and send batches, return the last one'''
+        tree = self.tree
+        tree.getOwners() # model takes them with first batch
+        batch = []
+        last = work = time.perf_counter()
+        i = 0
+        while i < len(tree.items) and not self.cancelled:
+            shadow = tree.items[i]
+            children = tree.newChildren(shadow)
+            if children:
+                batch.append((i, children[0].index, [(c.type, c.text, c.tag, c.tag_item, c.fetched) for c in children]))
+            tree.setChildren(shadow, children)
+            i += 1
+            now = time.perf_counter()
+            if batch and now - last > self.BATCH_SECONDS:
+                self.batchReady.emit(self, batch, False)
+                batch = []
+                last = now
+            if now - work > self.WORK_SECONDS:
+                time.sleep(self.PAUSE_SECONDS)
+                work = time.perf_counter()
+        return batch
+
+class SearchIndexBuilder(QThread):
+    '''Builds m3search.m3ModelSearch index in worker thread, pausing as ShadowTreeBuilder does'''
+    def __init__(self, search: m3ModelSearch):
+        super().__init__(None)
+        self.search = search
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        work = [time.perf_counter()]
+        def step() -> bool:
+            if time.perf_counter() - work[0] > ShadowTreeBuilder.WORK_SECONDS:
+                time.sleep(ShadowTreeBuilder.PAUSE_SECONDS)
+                work[0] = time.perf_counter()
+            return not self.cancelled
+        self.search.build(step)
 
 class TagTreeModel(QAbstractItemModel):
     TagTreeShadowRole = Qt.ItemDataRole.UserRole # type: 'Qt.ItemDataRole'
+    buildFinished = pyqtSignal()
+    ''' emitted when background build created whole tree '''
+    INSERT_SECONDS = 0.01
 
     def __init__(self) -> None:
         self.shadows = ShadowTree()
+        self.builder = None # type: ShadowTreeBuilder | None
+        self.builderMap = {} # type: Dict[int, int | None]
+        ''' builder tree index: own tree index, None for items that are not in own tree '''
+        self.pending = deque()
+        ''' batches received from builder and not inserted yet '''
+        self.builderDone = False
         super().__init__(None)
+        self.pendingTimer = QTimer(self)
+        self.pendingTimer.setSingleShot(True)
+        self.pendingTimer.timeout.connect(self.insertPending)
 
-    def changeM3(self, m3: m3File):
+    def changeM3(self, m3: m3File, background = False):
+        '''Show top level of model tree, if background is set, the rest is created in worker thread'''
+        self.stopBuilder()
         self.beginResetModel()
         self.shadows.processM3(m3)
         self.endResetModel()
+        if background and m3:
+            self.builder = ShadowTreeBuilder(m3)
+            self.builderMap = {0: 0, 1: 1}
+            self.builderDone = False
+            self.builder.batchReady.connect(self.insertBatch)
+            QTimer.singleShot(0, self.startBuilder) # let the rest of model loading finish first
+
+    def startBuilder(self):
+        if self.builder and not self.builder.isRunning() and not self.builder.isFinished():
+            self.builder.start(QThread.Priority.LowPriority)
+
+    def stopBuilder(self):
+        if self.builder:
+            self.builder.cancel()
+            self.builder.wait()
+            self.builder = None
+            self.builderMap = {}
+        self.pending.clear()
+        self.pendingTimer.stop()
+
+    def insertBatch(self, builder: ShadowTreeBuilder, batch, done: bool):
+        if builder is not self.builder: return # batch of cancelled build was already queued
+        if self.shadows.owners is None:
+            # found by builder before its first batch, own tree finds the same ones only if user expands it first
+            self.shadows.owners = builder.tree.owners
+        self.pending.extend(batch)
+        self.builderDone = done
+        if not self.pendingTimer.isActive():
+            self.pendingTimer.start(0)
+
+    def insertPending(self):
+        '''Insert children received from builder, stops after INSERT_SECONDS to keep GUI responsive and continues on next timer event'''
+        end = time.perf_counter() + self.INSERT_SECONDS
+        while self.pending and time.perf_counter() < end:
+            parent_idx, first, children = self.pending.popleft()
+            own = self.builderMap.get(parent_idx)
+            if own is None: continue
+            shadow = self.shadows.items[own]
+            if shadow.fetched: # expanded by user, children are the same unless tags were edited since
+                for row in range(len(children)):
+                    self.builderMap[first + row] = shadow.children[row] if row < len(shadow.children) else None
+                continue
+            items = [] # type: List[ShadowItem]
+            for row, (type, text, tag, tag_item, fetched) in enumerate(children):
+                item = ShadowItem(len(self.shadows.items) + row, type, own, row, text, tag, tag_item, fetched)
+                self.builderMap[first + row] = item.index
+                items.append(item)
+            self.beginInsertRows(self.createIndex(shadow.row, 0, own), 0, len(items) - 1)
+            self.shadows.items.extend(items)
+            self.shadows.setChildren(shadow, items)
+            self.endInsertRows()
+        if self.pending:
+            self.pendingTimer.start(0)
+        elif self.builderDone:
+            self.builder.wait()
+            self.builder = None
+            self.builderMap = {}
+            self.buildFinished.emit()
     
     def index(self, row: int, column: int, parent: QModelIndex = ...) -> QModelIndex:
         if not self.shadows or column>0:
@@ -203,7 +400,7 @@ class TagTreeModel(QAbstractItemModel):
         if parent.isValid():
             shadow = self.shadows.getShadow(parent.internalId())
         else:
-            return 2 if len(self.shadows.orphan_root.children)>0 else 1
+            return 2 if self.shadows.hasOrphans() else 1
         if shadow: return len(shadow.children)
         return 0
     
@@ -215,10 +412,8 @@ class TagTreeModel(QAbstractItemModel):
         if not self.shadows: return QVariant()
         shadow = self.shadows.getShadow(index.internalId())
         if not shadow: return QVariant()
-        if role == Qt.ItemDataRole.DisplayRole:
-            return shadow.text
-        if role == Qt.ItemDataRole.StatusTipRole:
-            return shadow.text
+        if role == Qt.ItemDataRole.DisplayRole or role == Qt.ItemDataRole.StatusTipRole:
+            return self.shadows.getText(shadow)
         if role == Qt.ItemDataRole.ToolTipRole and shadow.tag:
             return shadow.tag.info.descr
         if role == TagTreeModel.TagTreeShadowRole:
@@ -233,9 +428,66 @@ class TagTreeModel(QAbstractItemModel):
                 #shadow = self.shadows.root
                 return True
             if shadow:
-                return True if len(shadow.children)>0 else False
+                return self.shadows.mayHaveChildren(shadow)
+        return False
+
+    def canFetchMore(self, parent: QModelIndex) -> bool:
+        if self.shadows and parent.isValid():
+            shadow = self.shadows.getShadow(parent.internalId())
+            if shadow: return not shadow.fetched
         return False
 
+    def fetchMore(self, parent: QModelIndex):
+        shadow = self.shadows.getShadow(parent.internalId()) if parent.isValid() else None
+        if not shadow or shadow.fetched: return
+        children = self.shadows.newChildren(shadow)
+        if children: self.beginInsertRows(parent, 0, len(children) - 1)
+        self.shadows.setChildren(shadow, children)
+        if children: self.endInsertRows()
+
+    def shadowChildren(self, shadow: ShadowItem) -> List[ShadowItem]:
+        if not shadow.fetched:
+            self.fetchMore(self.createIndex(shadow.row, 0, shadow.index))
+        return [self.shadows.items[c] for c in shadow.children]
+
+    def findItemShadow(self, shadow: ShadowItem, item_idx: int) -> ShadowItem | None:
+        for child in self.shadowChildren(shadow):
+            if child.type == SHADOW_IT and child.tag_item == item_idx:
+                return child
+            if child.type == SHADOW_GRP and child.tag_item <= item_idx < child.tag_item + SHADOW_GRP_COUNT:
+                return self.findItemShadow(child, item_idx)
+        return None
+
+    def findTagItem(self, tag: m3Tag, item_idx = -1) -> QModelIndex:
+        '''Index of tag or its item in tree, found through owning references as tree shows them, rows on the way are fetched
+
+        If item has no row of its own (items of single field tags), index of tag is returned.
+        '''
+        m3 = self.shadows.m3
+        if not m3 or not tag: return QModelIndex()
+        owners = self.shadows.getOwners()
+        if tag.idx not in owners: return QModelIndex() # not reachable from model or orphan tags
+        path = [(tag.idx, item_idx)] # tag and item owning it up to MODL or orphan tag
+        seen = {tag.idx}
+        while owners.get(path[-1][0]) is not None:
+            owner = owners[path[-1][0]]
+            if owner[0] in seen: return QModelIndex()
+            seen.add(owner[0])
+            path.append((owner[0], owner[1]))
+        if path[-1][0] == m3.modl.idx:
+            shadow = self.shadows.root
+        else:
+            shadow = next((c for c in self.shadowChildren(self.shadows.orphan_root) if c.tag and c.tag.idx == path[-1][0]), None)
+        for k in range(len(path) - 1, -1, -1):
+            if shadow is None or path[k][1] < 0: break
+            item = self.findItemShadow(shadow, path[k][1])
+            if item is None: break
+            shadow = item
+            if k > 0:
+                shadow = next((c for c in self.shadowChildren(item) if c.type == SHADOW_TAG and c.tag.idx == path[k-1][0]), None)
+        if shadow is None: return QModelIndex()
+        return self.createIndex(shadow.row, 0, shadow.index)
+
 class fieldsTableModel(QAbstractItemModel):
     FieldRole = Qt.ItemDataRole.UserRole # type: 'Qt.ItemDataRole'
     SimpleFieldOffsetRole = Qt.ItemDataRole.UserRole + 1 # type: 'Qt.ItemDataRole'
@@ -426,7 +678,7 @@ class fieldsTableModel(QAbstractItemModel):
                 elif col == 2:
                     return self.tag.getFieldInfoStr(f)
                 elif col == 3:
-                    return self.tag.getFieldAsStr(item, f)
+                    return self.tag.getFieldAsStrCached(item, f)
             if role == fieldsTableModel.SimpleFieldOffsetRole:
                 return item * self.tag.info.item_size
         elif index.internalId() in range(0, len(self.tag.info.fields)):
@@ -441,7 +693,7 @@ class fieldsTableModel(QAbstractItemModel):
                 elif col == 3:
                     if self.handlers.hasHandler(f):
                         return self.handlers.fieldData(role, self.tag, self.tag_item, f)
-                    return self.tag.getFieldAsStr(self.tag_item, f)
+                    return self.tag.getFieldAsStrCached(self.tag_item, f)
             elif role == Qt.ItemDataRole.ToolTipRole:
                 tip = f.getHint()
                 if tip: return tip
@@ -453,6 +705,12 @@ class fieldsTableModel(QAbstractItemModel):
             return f.getHint(True)
         return self.dataDefault(role)
 
+    def fieldIndex(self, field: m3FieldInfo) -> QModelIndex:
+        '''Index of field row in fields view of structure'''
+        if not self.tag or self.tag.info.simple or self.binaryView or field.owner is not self.tag.info:
+            return QModelIndex()
+        return self.createIndex(field.tree_row, 0, field.index)
+
     def hasChildren(self, parent: QModelIndex) -> bool:
         if not parent.isValid(): return True
         if self.tag and not self.binaryView and not self.tag.info.simple and parent.column()==0: